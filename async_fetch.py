@@ -0,0 +1,25 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# Batch requests kept in flight at the same time by the async engine
+ENRICH_CONCURRENCY = 8
+
+def fetch_batches(fetch_batch, id_batches, concurrency=ENRICH_CONCURRENCY):
+    # Blocking entry point for the enrichment stages. Runs fetch_batch for every batch of IDs with up to concurrency requests in flight
+    # Results are returned in the same order as id_batches
+    # Bound here so calls made on the worker threads count against the calling stage
+    return asyncio.run(gather_batches(metrics.bind(fetch_batch), id_batches, concurrency))
+
+async def gather_batches(fetch_batch, id_batches, concurrency):
+    # fetch_batch is a blocking spotipy call, so each one runs on a worker thread while the event loop schedules them
+    # Sharing the spotipy client means the same OAuth token and session are used as the synchronous path
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        async def fetch(ids):
+            async with semaphore:
+                return await loop.run_in_executor(pool, fetch_batch, ids)
+
+        return await asyncio.gather(*(fetch(ids) for ids in id_batches))
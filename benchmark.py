@@ -0,0 +1,432 @@
+# Benchmark for the full extract pipeline against a synthetic local stand-in for the Spotify Web API
+# Each run calls sp_extract_data.run in a fresh process with its databases in a temporary folder and the HTTP session replaced by FakeSpotifySession
+# Reports wall time, API calls, peak RSS and rows/sec for every stage, read back from RUN_STAGE_METRICS
+#
+# Example: python benchmark.py --liked 20000 --playlists 500 --playlist-size 80 --latency-ms 25 --max-rate 40 --runs 2
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlsplit
+import requests
+
+API_PREFIX = "https://api.spotify.com/v1/"
+
+# Largest page size the real API allows for each paginated endpoint
+PAGE_MAXIMUMS = {
+    "me/tracks" : 50,
+    "me/top/tracks" : 50,
+    "me/playlists" : 50,
+    "playlist_items" : 100
+}
+
+# Roughly the shape of real payloads, the market list is what makes full track objects large
+MARKETS = ["M" + str(i) for i in range(180)]
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 3
+
+# Named library sizes, any of the values can be overridden on the command line
+PRESETS = {
+    "small" : {"liked": 1000, "playlists": 10, "playlist_size": 50, "top": 200},
+    "medium" : {"liked": 20000, "playlists": 300, "playlist_size": 80, "top": 1000},
+    "large" : {"liked": 200000, "playlists": 2000, "playlist_size": 100, "top": 1000}
+}
+
+class SyntheticLibrary:
+    # Deterministic library held as track numbers only, objects are built on request so the stand-in adds little to the measured memory
+
+    def __init__(self, liked, playlists, playlist_size, top, duplicate_rate, unavailable_rate, seed):
+        rng = random.Random(seed)
+        self.track_count = 0
+        self.unavailable_rate = unavailable_rate
+
+        def pick():
+            # Reuse an existing track at the duplicate rate, otherwise add a new one to the catalogue
+            if self.track_count and rng.random() < duplicate_rate:
+                return rng.randrange(self.track_count)
+            self.track_count += 1
+            return self.track_count - 1
+
+        self.liked = array("l", (pick() for _ in range(liked)))
+        self.playlists = [
+            array("l", (pick() for _ in range(max(0, int(rng.gauss(playlist_size, playlist_size / 3))))))
+            for _ in range(playlists)
+        ]
+        self.public = [rng.random() < 0.2 for _ in range(playlists)]
+        self.owned = [rng.random() < 0.7 for _ in range(playlists)]
+        self.top = {
+            time_range: array("l", rng.sample(range(self.track_count), min(top, self.track_count)))
+            for time_range in ("short_term", "medium_term", "long_term")
+        }
+
+    def track(self, number):
+        album = number // TRACKS_PER_ALBUM
+        artist = album // ALBUMS_PER_ARTIST
+        return {
+            "id": f"track{number}",
+            "name": f"Track {number}",
+            "type": "track",
+            "duration_ms": 120000 + number % 180000,
+            "popularity": number % 100,
+            "explicit": False,
+            "available_markets": MARKETS,
+            "external_urls": {"spotify": f"https://open.spotify.com/track/track{number}"},
+            "artists": [{"id": f"artist{artist}", "name": f"Artist {artist}", "type": "artist"}],
+            "album": self.simplified_album(album)
+        }
+
+    def simplified_album(self, album):
+        return {
+            "id": f"album{album}",
+            "name": f"Album {album}",
+            "album_type": "album",
+            "release_date": f"{1960 + album % 60}-01-01",
+            "total_tracks": TRACKS_PER_ALBUM,
+            "available_markets": MARKETS,
+            "images": [{"url": f"https://i.scdn.co/image/{album}/{size}", "height": size, "width": size} for size in (640, 300, 64)]
+        }
+
+    def album(self, album):
+        return dict(self.simplified_album(album), popularity=album % 100, genres=[], label="Benchmark")
+
+    def artist(self, artist):
+        return {
+            "id": f"artist{artist}",
+            "name": f"Artist {artist}",
+            "type": "artist",
+            "popularity": artist % 100,
+            "genres": ["benchmark"],
+            "followers": {"total": artist * 10},
+            "images": [{"url": f"https://i.scdn.co/image/a{artist}", "height": 640, "width": 640}]
+        }
+
+    def playlist_item(self, number, position):
+        # A small share of playlist entries are unavailable and come back without a track
+        unavailable = (number * 7919 + position) % 1000 < self.unavailable_rate * 1000
+        return {"added_at": "2024-01-01T00:00:00Z", "added_by": {"id": "benchmark"}, "is_local": False,
+                "track": None if unavailable else self.track(number)}
+
+def parse_fields(fields):
+    # Parse a Web API fields filter, e.g. "items(added_at,track(id)),total", into {key: sub-filter or None}
+    # Dotted paths ("items.track.id") are treated the same as nested brackets
+    tree = {}
+    stack = [tree]
+    current = tree
+    key = ""
+    for char in fields + ",":
+        if char in ",().":
+            if key:
+                current.setdefault(key, None)
+            if char in "(.":
+                current[key] = current[key] or {}
+                stack.append(current[key] if char == "(" else None)
+                current = current[key]
+            elif char == ")":
+                stack.pop()
+                current = stack[-1]
+            elif stack[-1] is None:
+                # End of a dotted path, go back to the enclosing bracket
+                while stack[-1] is None:
+                    stack.pop()
+                current = stack[-1]
+            key = ""
+        else:
+            key += char
+    return tree
+
+def project(value, tree):
+    # Apply a parsed fields filter to a response body
+    if tree is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    return {key: project(value[key], subtree) for key, subtree in tree.items() if key in value}
+
+def liked_added_at(position):
+    # Liked tracks come newest first, one minute apart
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1700000000 - position * 60))
+
+class FakeSpotifySession(requests.Session):
+    # requests session that answers Spotify Web API calls from a SyntheticLibrary
+    # latency is added to every call, and calls above max_rate per second get a 429 with Retry-After
+
+    def __init__(self, library, latency, max_rate=None):
+        super().__init__()
+        self.library = library
+        self.latency = latency
+        self.max_rate = max_rate
+        self.calls = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_calls = 0
+
+    def request(self, method, url, params=None, **kwargs):
+        with self.lock:
+            self.calls += 1
+            throttle = self.over_rate()
+
+        start = time.monotonic()
+        time.sleep(self.latency * (0.5 + random.random()))
+
+        if throttle:
+            status, body, headers = 429, {"error": {"status": 429, "message": "API rate limit exceeded"}}, {"Retry-After": "1"}
+        else:
+            status, body, headers = self.route(url, {key: value for key, value in (params or {}).items() if value is not None})
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(body).encode()
+        response.headers.update(headers)
+        response.url = url
+        response.reason = "OK" if status == 200 else "Error"
+        response.elapsed = timedelta(seconds=time.monotonic() - start)
+
+        for hook in self.hooks["response"]:
+            hook(response)
+        return response
+
+    def over_rate(self):
+        # Fixed one second windows, enough to exercise the client's 429 handling
+        if not self.max_rate:
+            return False
+        now = time.monotonic()
+        if now - self.window_start >= 1:
+            self.window_start = now
+            self.window_calls = 0
+        self.window_calls += 1
+        if self.window_calls > self.max_rate:
+            self.throttled += 1
+            return True
+        return False
+
+    def route(self, url, params):
+        parts = urlsplit(url)
+        path = parts.path.split("/v1/", 1)[-1].rstrip("/")
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        query.update(params)
+        library = self.library
+
+        if path == "me":
+            return 200, {"id": "benchmark", "display_name": "Benchmark User"}, {}
+        if path == "me/tracks":
+            return 200, self.page(path, query, library.liked, lambda number, position: {"added_at": liked_added_at(position), "track": library.track(number)}), {}
+        if path == "me/top/tracks":
+            return 200, self.page(path, query, library.top[query.get("time_range", "medium_term")], lambda number, position: library.track(number)), {}
+        if path == "me/playlists":
+            return 200, self.page(path, query, array("l", range(len(library.playlists))), self.playlist), {}
+        if path.startswith("playlists/") and path.endswith(("/tracks", "/items")):
+            playlist = int(path.split("/")[1].removeprefix("playlist"))
+            body = self.page("playlist_items", query, library.playlists[playlist], library.playlist_item)
+            if "fields" in query:
+                body = project(body, parse_fields(query["fields"]))
+            return 200, body, {}
+        if path in ("tracks", "albums", "artists"):
+            ids = query["ids"].split(",")
+            build = {"tracks": (library.track, "track"), "albums": (library.album, "album"), "artists": (library.artist, "artist")}[path]
+            return 200, {path: [build[0](int(entity_id.removeprefix(build[1]))) for entity_id in ids]}, {}
+
+        return 404, {"error": {"status": 404, "message": f"No benchmark route for {path}"}}, {}
+
+    def playlist(self, number, position):
+        library = self.library
+        return {
+            "id": f"playlist{number}",
+            "name": f"Playlist {number}",
+            "type": "playlist",
+            "public": library.public[number],
+            "snapshot_id": f"snapshot{number}",
+            "owner": {"display_name": "Benchmark User" if library.owned[number] else f"Friend {number}"},
+            "tracks": {"total": len(library.playlists[number])},
+            "images": [{"url": f"https://i.scdn.co/image/p{number}", "height": 640, "width": 640}]
+        }
+
+    def page(self, endpoint, query, numbers, build):
+        limit = min(int(query.get("limit", 20)), PAGE_MAXIMUMS[endpoint])
+        offset = int(query.get("offset", 0))
+        items = [build(number, position) for position, number in enumerate(numbers[offset:offset + limit], offset)]
+        return {
+            "items": items,
+            "limit": limit,
+            "offset": offset,
+            "total": len(numbers),
+            "next": f"{API_PREFIX}{endpoint}?offset={offset + limit}&limit={limit}" if offset + limit < len(numbers) else None,
+            "previous": None
+        }
+
+def read_peak_rss():
+    # Peak RSS in MiB since the last reset_peak_rss, from /proc (Linux). None where unavailable
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+def reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM so each stage's peak can be measured on its own
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+def run_pipeline(config, work_dir, results):
+    # Child process body. Points the extract at work_dir and the fake session, runs the configured stages and reports back
+    os.environ["SP_DB_PATH"] = os.path.join(work_dir, "sp_data.db")
+    os.environ["SP_CACHE_PATH"] = os.path.join(work_dir, "sp_cache.db")
+    for variable in ("SPOTIPY_CLIENT_ID", "SPOTIPY_CLIENT_SECRET", "SPOTIPY_REDIRECT_URI"):
+        os.environ.setdefault(variable, "http://127.0.0.1/benchmark")
+
+    library = SyntheticLibrary(
+        config["liked"], config["playlists"], config["playlist_size"], config["top"],
+        config["duplicate_rate"], config["unavailable_rate"], config["seed"])
+    session = FakeSpotifySession(library, config["latency_ms"] / 1000, config["max_rate"])
+
+    import metrics
+    import rate_limit
+
+    # Same client class, but talking to the fake session with a fixed token instead of the OAuth cache
+    class BenchmarkSpotify(rate_limit.RateLimitedSpotify):
+        def __init__(self, *args, **kwargs):
+            kwargs.pop("auth_manager", None)
+            super().__init__(*args, auth="benchmark-token", requests_session=session, **kwargs)
+
+    rate_limit.RateLimitedSpotify = BenchmarkSpotify
+
+    # Peak RSS for each stage, sampled around metrics' stage boundaries
+    # The peak is process wide, so stages running at the same time share one. Use --max-parallel 1 to measure stages on their own
+    stage_rss = {}
+    start_stage, finish_stage = metrics.start_stage, metrics.finish_stage
+
+    def start_stage_with_rss(name):
+        reset_peak_rss()
+        start_stage(name)
+
+    def finish_stage_with_rss():
+        stage = metrics._current_stage.get()
+        if stage is not None:
+            stage_rss[stage.name] = read_peak_rss()
+        finish_stage()
+
+    metrics.start_stage, metrics.finish_stage = start_stage_with_rss, finish_stage_with_rss
+
+    run_start = datetime.now()
+    start = time.perf_counter()
+    import sp_extract_data
+    parallel = {"max_parallel": config["max_parallel"]} if config["max_parallel"] else {}
+    sp_extract_data.run(config["stages"] or sp_extract_data.STAGE_NAMES, force=config["force"], **parallel)
+    wall_time = time.perf_counter() - start
+
+    db = sqlite3.connect(os.environ["SP_DB_PATH"])
+    stages = db.execute("""
+        SELECT STAGE, DURATION_SECONDS, API_CALLS, BYTES_RECEIVED, ROWS_WRITTEN, RETRIES, THROTTLED, CACHE_HITS, CACHE_MISSES
+        FROM RUN_STAGE_METRICS
+        WHERE RUN_ID = ?
+        ORDER BY START_TIME
+    """, (metrics.RUN_ID,)).fetchall()
+    failures = db.execute("""
+        SELECT script_name, script_error_message FROM LOGGING_TABLE WHERE script_success = 0 AND script_start_time >= ?
+    """, (run_start,)).fetchall()
+    db.close()
+
+    results.put({
+        "wall_time": wall_time,
+        "api_calls": session.calls,
+        "server_throttled": session.throttled,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": [dict(zip(("stage", "seconds", "api_calls", "bytes_received", "rows", "retries", "throttled", "cache_hits", "cache_misses"), stage), peak_rss_mb=stage_rss.get(stage[0])) for stage in stages],
+        "failures": failures
+    })
+
+def run(config, runs):
+    # Run the pipeline runs times in fresh processes against the same folder, so later runs show the effect of caches and incremental sync
+    context = multiprocessing.get_context("spawn")
+    reports = []
+    with tempfile.TemporaryDirectory(prefix="sp_benchmark_") as work_dir:
+        for _ in range(runs):
+            results = context.Queue()
+            process = context.Process(target=run_pipeline, args=(config, work_dir, results))
+            process.start()
+            reports.append(wait_for_report(process, results))
+            process.join()
+    return reports
+
+def wait_for_report(process, results, poll_seconds=1):
+    # Report of a benchmark process. Raises if the process exits without one (its traceback is printed by multiprocessing), rather than waiting forever
+    while True:
+        try:
+            return results.get(timeout=poll_seconds)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        # The report may still be on its way through the queue's pipe when the process is seen to exit
+        try:
+            return results.get(timeout=poll_seconds)
+        except queue.Empty:
+            raise RuntimeError(f"Benchmark run exited with code {process.exitcode} without a report")
+
+def print_report(number, report):
+    print(f"\nRun {number}: {report['wall_time']:.2f}s wall, {report['api_calls']} API calls "
+          f"({report['server_throttled']} throttled by server), peak RSS {report['peak_rss_mb']:.1f} MiB")
+    print(f"{'stage':<42}{'seconds':>9}{'calls':>8}{'KiB':>9}{'rows':>9}{'rows/s':>11}{'retries':>9}{'rss MiB':>9}")
+    for stage in report["stages"]:
+        rows_per_second = stage["rows"] / stage["seconds"] if stage["seconds"] else 0
+        rss = f"{stage['peak_rss_mb']:.1f}" if stage["peak_rss_mb"] else "-"
+        print(f"{stage['stage'][:41]:<42}{stage['seconds']:>9.3f}{stage['api_calls']:>8}{stage['bytes_received'] / 1024:>9.0f}{stage['rows']:>9}{rows_per_second:>11.0f}{stage['retries']:>9}{rss:>9}")
+    for script_name, error_message in report["failures"]:
+        print(f"FAILED {script_name}: {error_message}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the extract pipeline against a synthetic Spotify library")
+    parser.add_argument("--preset", choices=PRESETS, default="small")
+    parser.add_argument("--liked", type=int)
+    parser.add_argument("--playlists", type=int)
+    parser.add_argument("--playlist-size", type=int)
+    parser.add_argument("--top", type=int)
+    parser.add_argument("--duplicate-rate", type=float, default=0.6, help="share of collection entries reusing a track already in the library")
+    parser.add_argument("--unavailable-rate", type=float, default=0.01, help="share of playlist entries without a track")
+    parser.add_argument("--latency-ms", type=float, default=20, help="mean latency added to every API call")
+    parser.add_argument("--max-rate", type=float, default=None, help="requests per second before the fake API answers 429")
+    parser.add_argument("--runs", type=int, default=1, help="runs against the same databases")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--stages", nargs="+", help="only run these sp_extract_data stages")
+    parser.add_argument("--force", action="store_true", help="run enrichment even if its inputs haven't changed")
+    parser.add_argument("--max-parallel", type=int, default=None, help="sp_extract_data stages run at the same time")
+    parser.add_argument("--json", action="store_true", help="print the reports as JSON")
+    args = parser.parse_args()
+
+    config = dict(PRESETS[args.preset])
+    for key in ("liked", "playlists", "playlist_size", "top"):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    config.update(
+        duplicate_rate=args.duplicate_rate,
+        unavailable_rate=args.unavailable_rate,
+        latency_ms=args.latency_ms,
+        max_rate=args.max_rate,
+        seed=args.seed,
+        stages=args.stages,
+        force=args.force,
+        max_parallel=args.max_parallel)
+
+    reports = run(config, args.runs)
+    if args.json:
+        print(json.dumps({"config": config, "runs": reports}, indent=2, default=str))
+    else:
+        print(f"Library: {config}")
+        for number, report in enumerate(reports, 1):
+            print_report(number, report)
+
+if __name__ == "__main__":
+    main()
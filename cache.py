@@ -0,0 +1,188 @@
+import json
+import os
+import sqlite3
+import time
+import metrics
+import utilities
+
+# On disk cache of API entity payloads (tracks, albums, artists), kept seperate from the extract database
+# SP_CACHE_PATH in the environment overrides it. One cache can be shared by several processes (see multi_account)
+CACHE_PATH = os.environ.get("SP_CACHE_PATH", '/usr/files/spotify_data/sp_cache.db')
+
+# Oldest entries (by last use) are evicted once payloads exceed this size
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+# Each field class has its own time to live in seconds. Popularity moves daily, names and release dates almost never do
+FIELD_CLASS_TTLS = {
+    "stable" : 30 * 24 * 60 * 60,
+    "volatile" : 7 * 24 * 60 * 60
+}
+
+# Fields of each entity type that belong to the volatile class, everything else is stable
+VOLATILE_FIELDS = {
+    "track" : ("popularity",),
+    "album" : ("popularity",),
+    "artist" : ("popularity", "followers")
+}
+
+# Large payload keys that are never stored in the extract, dropped before caching
+DROPPED_KEYS = ("available_markets", "images")
+
+# Seconds a process waits for another's write to the cache to finish. Writes are committed per batch so waits stay short
+BUSY_TIMEOUT = 60
+
+# SQLite limits the amount of variables in one statement, lookups are split into chunks of this size
+LOOKUP_CHUNK = 500
+
+stats = {
+    "hits" : 0,
+    "misses" : 0,
+    "expired" : 0,
+    "evicted" : 0
+}
+
+_db = None
+
+def get_db():
+    # Open the cache database on first use and create the cache table if needed
+    global _db
+    if _db is None:
+        # Only one stage uses the cache at a time, but it isn't always the thread that opened it
+        _db = sqlite3.connect(CACHE_PATH, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode = WAL")
+        _db.execute("PRAGMA synchronous = NORMAL")
+        _db.execute("""
+        CREATE TABLE IF NOT EXISTS ENTITY_CACHE(
+            ENTITY_TYPE TEXT,
+            ENTITY_ID TEXT,
+            PAYLOAD TEXT,
+            SIZE INTEGER,
+            FETCHED_AT REAL,
+            LAST_USED REAL,
+            PRIMARY KEY (ENTITY_TYPE, ENTITY_ID))
+        """)
+        _db.execute("""
+        CREATE INDEX IF NOT EXISTS ENTITY_CACHE_LAST_USED ON ENTITY_CACHE(LAST_USED)
+        """)
+        _db.commit()
+    return _db
+
+def strip_payload(payload):
+    # Recursively remove the dropped keys from an API payload
+    if isinstance(payload, dict):
+        return {key: strip_payload(value) for key, value in payload.items() if key not in DROPPED_KEYS}
+    if isinstance(payload, list):
+        return [strip_payload(value) for value in payload]
+    return payload
+
+def max_age(entity_type, fields):
+    # An entry is only usable if it is fresh for every field class the caller reads
+    if any(field in VOLATILE_FIELDS.get(entity_type, ()) for field in fields):
+        return min(FIELD_CLASS_TTLS["stable"], FIELD_CLASS_TTLS["volatile"])
+    return FIELD_CLASS_TTLS["stable"]
+
+def lookup(entity_type, ids, fields, project=None):
+    # Function to return {ID: payload} for the IDs with a usable cache entry, and the IDs that need to be fetched (unique, in order)
+    # fields are the payload keys the caller reads, which decide the TTL applied
+    # project optionally converts each payload as it is read (e.g. to a records class), so only the converted values are kept
+    db = get_db()
+    now = time.time()
+    oldest_allowed = now - max_age(entity_type, fields)
+    unique_ids = list(dict.fromkeys(ids))
+    payloads = {}
+    expired_count = 0
+
+    for ids_chunk in utilities.chunk_list(unique_ids, LOOKUP_CHUNK):
+        rows = db.execute(f"""
+            SELECT ENTITY_ID, PAYLOAD, FETCHED_AT
+            FROM ENTITY_CACHE
+            WHERE ENTITY_TYPE = ? AND ENTITY_ID IN ({",".join("?" * len(ids_chunk))})
+        """, [entity_type, *ids_chunk]).fetchall()
+
+        for entity_id, payload, fetched_at in rows:
+            if fetched_at >= oldest_allowed:
+                payload = json.loads(payload)
+                payloads[entity_id] = project(payload) if project else payload
+            else:
+                expired_count += 1
+
+    hit_ids = list(payloads)
+    stats["hits"] += len(hit_ids)
+    metrics.count("cache_hits", len(hit_ids))
+    db.executemany("""
+        UPDATE ENTITY_CACHE SET LAST_USED = ? WHERE ENTITY_TYPE = ? AND ENTITY_ID = ?
+    """, [(now, entity_type, entity_id) for entity_id in hit_ids])
+    db.commit()
+
+    missing_ids = [entity_id for entity_id in unique_ids if entity_id not in payloads]
+    stats["expired"] += expired_count
+    stats["misses"] += len(missing_ids) - expired_count
+    metrics.count("cache_misses", len(missing_ids))
+
+    return payloads, missing_ids
+
+def get_many(entity_type, ids, fetch_batch, batch_size, fields, fetch_batches=None, project=None):
+    # Function to return the payload for each ID (in the same order), calling fetch_batch only for misses and expired entries
+    # fetch_batch takes a list of at most batch_size IDs and returns the payloads in the same order
+    # fields are the payload keys the caller reads, which decide the TTL applied
+    # fetch_batches optionally replaces the one by one fetch_batch calls, taking every batch at once and returning a list of results per batch
+    # project optionally converts each payload once it is cached, and the converted values are returned instead. Full payloads are only held one batch at a time
+    payloads, missing_ids = lookup(entity_type, ids, fields, project)
+
+    # Anything not served from the cache goes to the API in full batches
+    now = time.time()
+    id_batches = list(utilities.chunk_list(missing_ids, batch_size))
+    if fetch_batches is None:
+        fetched_batches = (fetch_batch(ids_chunk) for ids_chunk in id_batches)
+    else:
+        fetched_batches = fetch_batches(id_batches)
+
+    for ids_chunk, fetched in zip(id_batches, fetched_batches):
+        put_many(entity_type, ids_chunk, fetched, now)
+        payloads.update(zip(ids_chunk, map(project, fetched) if project else fetched))
+
+    evict()
+
+    return [payloads.get(entity_id) for entity_id in ids]
+
+def put_many(entity_type, ids, payloads, fetched_at):
+    # Store fetched payloads. Unavailable entities come back as None and are not cached
+    rows = []
+    for entity_id, payload in zip(ids, payloads):
+        if payload is None:
+            continue
+        payload = json.dumps(strip_payload(payload), separators=(",", ":"))
+        rows.append((entity_type, entity_id, payload, len(payload), fetched_at, fetched_at))
+
+    get_db().executemany("""
+        INSERT OR REPLACE INTO ENTITY_CACHE (
+            ENTITY_TYPE,
+            ENTITY_ID,
+            PAYLOAD,
+            SIZE,
+            FETCHED_AT,
+            LAST_USED)
+        VALUES(?, ?, ?, ?, ?, ?)
+    """, rows)
+    get_db().commit()
+
+def evict():
+    # Remove least recently used entries until the cache is back under MAX_CACHE_BYTES, called once a caller has stored everything it fetched
+    db = get_db()
+    total_size = db.execute("SELECT COALESCE(SUM(SIZE), 0) FROM ENTITY_CACHE").fetchone()[0]
+    if total_size <= MAX_CACHE_BYTES:
+        return
+
+    excess = total_size - MAX_CACHE_BYTES
+    evicted = []
+    for entity_type, entity_id, size in db.execute("""
+        SELECT ENTITY_TYPE, ENTITY_ID, SIZE FROM ENTITY_CACHE ORDER BY LAST_USED
+    """):
+        evicted.append((entity_type, entity_id))
+        excess -= size
+        if excess <= 0:
+            break
+
+    db.executemany("DELETE FROM ENTITY_CACHE WHERE ENTITY_TYPE = ? AND ENTITY_ID = ?", evicted)
+    db.commit()
+    stats["evicted"] += len(evicted)
@@ -0,0 +1,138 @@
+from concurrent.futures import Future
+import queue
+import threading
+import time
+import metrics
+import utilities
+
+# Units waiting to be written before producers are made to wait (backpressure)
+WRITER_QUEUE_UNITS = 64
+
+# Queued units are committed together once they hold this many rows, or once the first has waited GROUP_COMMIT_SECONDS
+GROUP_COMMIT_ROWS = 5000
+GROUP_COMMIT_SECONDS = 0.2
+
+def statement(sql, parameters=()):
+    # A statement run once, for DatabaseWriter.write
+    return (sql, [parameters])
+
+def insert(table, columns, rows):
+    # A statement inserting row tuples (in column order), for DatabaseWriter.write. Rows are counted against the calling stage
+    rows = list(rows)
+    metrics.count("rows_written", len(rows))
+    return (f"""
+        INSERT INTO {table} ({", ".join(columns)})
+        VALUES({", ".join("?" * len(columns))})
+    """, rows)
+
+class DatabaseWriter:
+    # Single writer for a database. Producers on any thread queue units of statements, and one thread with its own connection commits them
+    # Units are grouped into one transaction by size or time, so many small writes (e.g. one per page) share a commit
+    # Each unit is atomic. If a group fails its units are retried one per transaction, so only the failing unit's producer sees the error
+
+    def __init__(self, db_path=utilities.DB_PATH, queue_units=WRITER_QUEUE_UNITS, commit_rows=GROUP_COMMIT_ROWS, commit_seconds=GROUP_COMMIT_SECONDS):
+        self.db_path = db_path
+        self.queue = queue.Queue(maxsize=queue_units)
+        self.commit_rows = commit_rows
+        self.commit_seconds = commit_seconds
+        self.stats = {
+            "units" : 0,
+            "rows" : 0,
+            "commits" : 0,
+            "failed_units" : 0
+        }
+        self.commit_latencies = []
+        self.queue_depths = []
+        self.thread = threading.Thread(target=self.run, name="database-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, statements, wait=False):
+        # Queue a unit of (sql, list of parameter rows) statements, as built by statement and insert. They run with executemany in order and are committed together
+        # Returns a Future resolved once the unit is committed, or with the error that rolled it back. Blocks while the queue is full
+        # wait blocks until the unit is committed (raising its error), and commits its group straight away rather than holding it for more units
+        future = Future()
+        self.queue.put((statements, sum(len(parameters) for sql, parameters in statements), future, wait))
+        if wait:
+            future.result()
+        return future
+
+    def flush(self):
+        # Wait until everything queued so far is committed
+        self.write([], wait=True)
+
+    def wait_all(self, futures):
+        # Wait for every write, committing them straight away, and raise the first error
+        self.flush()
+        for future in futures:
+            future.result()
+
+    def close(self):
+        # Commit anything still queued and stop the writer thread
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        db = utilities.connect(self.db_path)
+        try:
+            closing = False
+            while not closing:
+                unit = self.queue.get()
+                if unit is None:
+                    break
+                self.queue_depths.append(self.queue.qsize() + 1)
+
+                # Take more units until the group is big enough, the first has waited long enough, or a producer is waiting on the last
+                group = [unit]
+                row_count = unit[1]
+                deadline = time.monotonic() + self.commit_seconds
+                while not unit[3] and row_count < self.commit_rows:
+                    try:
+                        unit = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if unit is None:
+                        closing = True
+                        break
+                    group.append(unit)
+                    row_count += unit[1]
+
+                self.commit(db, group)
+        finally:
+            db.close()
+
+    def commit(self, db, group):
+        start = time.perf_counter()
+        try:
+            with utilities.transaction(db):
+                for statements, row_count, future, wait in group:
+                    for sql, parameters in statements:
+                        db.executemany(sql, parameters)
+        except Exception as e:
+            if len(group) == 1:
+                self.stats["failed_units"] += 1
+                group[0][2].set_exception(e)
+                return
+            for unit in group:
+                self.commit(db, [unit])
+            return
+
+        self.commit_latencies.append(time.perf_counter() - start)
+        self.stats["commits"] += 1
+        self.stats["units"] += len(group)
+        self.stats["rows"] += sum(unit[1] for unit in group)
+        for unit in group:
+            unit[2].set_result(None)
+
+    def metrics_row(self):
+        # Values of RUN_WRITER_METRICS after RUN_ID: units, rows and commits, failed units, p50/p95 commit latency and the queue depth (units waiting when each group was started)
+        latencies = sorted(self.commit_latencies)
+        return (
+            self.stats["units"],
+            self.stats["rows"],
+            self.stats["commits"],
+            self.stats["failed_units"],
+            metrics.percentile(latencies, 50),
+            metrics.percentile(latencies, 95),
+            sum(self.queue_depths) / len(self.queue_depths) if self.queue_depths else None,
+            max(self.queue_depths, default=None)
+        )
@@ -0,0 +1,108 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import time
+import cache
+import metrics
+
+# Batch requests in flight at the same time, shared by every entity type in the pipeline
+PIPELINE_CONCURRENCY = 8
+
+class EnrichmentPipeline:
+    # Resolves entity payloads (tracks, albums, artists) through the cache, fetching misses in batches on one shared pool
+    # Handlers receive payloads as each batch resolves and can queue more IDs, e.g. the albums of a track batch, so later entity types overlap with earlier ones
+    # Only the API calls run on the pool. Cache lookups, handlers and any database writes they make stay on the calling thread
+
+    def __init__(self, concurrency=PIPELINE_CONCURRENCY):
+        self.concurrency = concurrency
+        self.entity_types = {}
+        self.in_flight = {}
+
+    def add_entity_type(self, entity_type, fetch_batch, batch_size, fields, handler, sources=(), project=None):
+        # fetch_batch takes a list of at most batch_size IDs and returns the payloads in the same order, fields decide the cache TTL
+        # handler is called with lists of IDs and their payloads, once for cache hits and once per fetched batch
+        # sources are the entity types whose handlers queue IDs of this type
+        # project optionally converts payloads before they reach the handler (fetched payloads are cached in full first)
+        self.entity_types[entity_type] = {
+            "fetch_batch" : metrics.bind(fetch_batch),
+            "batch_size" : batch_size,
+            "fields" : fields,
+            "handler" : handler,
+            "sources" : sources,
+            "project" : project,
+            "seen" : set(),
+            "queue" : [],
+            "finished_at" : None
+        }
+
+    def put(self, entity_type, ids):
+        # Queue IDs for an entity type, IDs already queued are skipped
+        # Cached payloads go to the handler straight away, misses wait in the queue until a worker is free
+        entity = self.entity_types[entity_type]
+        new_ids = []
+        for entity_id in ids:
+            if entity_id is not None and entity_id not in entity["seen"]:
+                entity["seen"].add(entity_id)
+                new_ids.append(entity_id)
+        if not new_ids:
+            return
+
+        payloads, missing_ids = cache.lookup(entity_type, new_ids, entity["fields"], entity["project"])
+        entity["queue"].extend(missing_ids)
+        if payloads:
+            self.resolve(entity_type, list(payloads), list(payloads.values()))
+
+    def resolve(self, entity_type, ids, payloads):
+        entity = self.entity_types[entity_type]
+        entity["handler"](ids, payloads)
+        entity["finished_at"] = datetime.now()
+
+    def drained(self, entity_type):
+        # No more IDs can be queued for an entity type once every source type has nothing queued or in flight
+        in_flight_types = {batch[0] for batch in self.in_flight.values()}
+        return all(
+            not self.entity_types[source]["queue"] and source not in in_flight_types and self.drained(source)
+            for source in self.entity_types[entity_type]["sources"])
+
+    def next_batch(self):
+        # Full batches are taken in turn from each entity type, so no type waits behind another's backlog
+        # A partial batch is only sent once no type has a full one, and no more IDs can arrive for its type
+        for full_only in (True, False):
+            for entity_type, entity in self.entity_types.items():
+                queue = entity["queue"]
+                if queue and (len(queue) >= entity["batch_size"] or (not full_only and self.drained(entity_type))):
+                    ids = queue[:entity["batch_size"]]
+                    del queue[:entity["batch_size"]]
+
+                    # Rotate so the next batch starts with the following entity type
+                    self.entity_types[entity_type] = self.entity_types.pop(entity_type)
+                    return entity_type, ids
+        return None
+
+    def run(self):
+        # Fetch until every queue is empty and no batch is in flight, then trim the cache
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while True:
+                while len(self.in_flight) < self.concurrency:
+                    batch = self.next_batch()
+                    if batch is None:
+                        break
+                    entity_type, ids = batch
+                    future = pool.submit(self.entity_types[entity_type]["fetch_batch"], ids)
+                    self.in_flight[future] = batch
+
+                if not self.in_flight:
+                    break
+
+                done, _ = wait(self.in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entity_type, ids = self.in_flight.pop(future)
+                    payloads = future.result()
+                    cache.put_many(entity_type, ids, payloads, time.time())
+                    project = self.entity_types[entity_type]["project"]
+                    self.resolve(entity_type, ids, list(map(project, payloads)) if project else payloads)
+
+        cache.evict()
+
+    def finished_at(self, entity_type):
+        # Time the last payload of an entity type was handled, None if there were none
+        return self.entity_types[entity_type]["finished_at"]
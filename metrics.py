@@ -0,0 +1,242 @@
+import contextvars
+import math
+import threading
+from datetime import datetime
+from urllib.parse import urlsplit
+
+# Identifies every metrics row written by this process
+RUN_ID = datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+# Counters kept for each stage, also the column order of RUN_STAGE_METRICS after the timing columns
+COUNTERS = ("api_calls", "pages_fetched", "bytes_received", "rows_written", "retries", "throttled", "cache_hits", "cache_misses")
+
+# Stage being measured. Worker threads get the stage of whoever submitted the work through bind()
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+_lock = threading.Lock()
+
+# Finished stage rows waiting to be written by flush()
+_pending = []
+
+# API path segments followed by an ID, which is replaced so calls are grouped by endpoint (e.g. playlists/{id}/tracks)
+ID_PARENTS = ("playlists", "users", "albums", "artists", "tracks", "shows", "episodes")
+
+# Calls of the whole run by endpoint, written by flush() at the end of the run
+_endpoints = {}
+
+# Run level rows of components with a metrics table of their own (e.g. the database writer), as {table: [rows]}, written by flush()
+_pending_components = {}
+
+# Tables of run level rows, cleared along with the stage rows of their run
+RUN_TABLES = ("RUN_ENDPOINT_METRICS", "RUN_WRITER_METRICS", "RUN_TRANSPORT_METRICS")
+
+class StageMetrics:
+    # Counters, API latencies and timings of one stage
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = datetime.now()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.latencies = []
+
+    def row(self):
+        end_time = datetime.now()
+        latencies = sorted(self.latencies)
+        return (
+            RUN_ID,
+            self.name,
+            self.start_time,
+            end_time,
+            (end_time - self.start_time).total_seconds(),
+            percentile(latencies, 50),
+            percentile(latencies, 95),
+            percentile(latencies, 99),
+            *(self.counters[counter] for counter in COUNTERS)
+        )
+
+class EndpointMetrics:
+    # Calls, latencies and bytes of one API endpoint across the run. bytes_received is as sent over the wire (compressed), bytes_decoded after decompression
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.latencies = []
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+    def row(self):
+        latencies = sorted(self.latencies)
+        return (
+            RUN_ID,
+            self.name,
+            self.calls,
+            percentile(latencies, 50),
+            percentile(latencies, 95),
+            percentile(latencies, 99),
+            self.bytes_received,
+            self.bytes_decoded
+        )
+
+# Anything recorded outside a stage (e.g. authentication at start up) is counted against the run as a whole
+_run = StageMetrics("RUN")
+
+def percentile(sorted_values, percent):
+    # Nearest rank percentile in milliseconds, None if no calls were made
+    if not sorted_values:
+        return None
+    rank = max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank] * 1000
+
+def init_tables(db):
+    # Create the metrics table next to LOGGING_TABLE, and clear rows more than a month old in line with the logs
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS RUN_STAGE_METRICS(
+        RUN_ID TEXT,
+        STAGE TEXT,
+        START_TIME TEXT,
+        END_TIME TEXT,
+        DURATION_SECONDS REAL,
+        LATENCY_P50_MS REAL,
+        LATENCY_P95_MS REAL,
+        LATENCY_P99_MS REAL,
+        API_CALLS INTEGER,
+        PAGES_FETCHED INTEGER,
+        BYTES_RECEIVED INTEGER,
+        ROWS_WRITTEN INTEGER,
+        RETRIES INTEGER,
+        THROTTLED INTEGER,
+        CACHE_HITS INTEGER,
+        CACHE_MISSES INTEGER)
+    """)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS RUN_ENDPOINT_METRICS(
+        RUN_ID TEXT,
+        ENDPOINT TEXT,
+        CALLS INTEGER,
+        LATENCY_P50_MS REAL,
+        LATENCY_P95_MS REAL,
+        LATENCY_P99_MS REAL,
+        BYTES_RECEIVED INTEGER,
+        BYTES_DECODED INTEGER)
+    """)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS RUN_WRITER_METRICS(
+        RUN_ID TEXT,
+        UNITS INTEGER,
+        ROWS_WRITTEN INTEGER,
+        COMMITS INTEGER,
+        FAILED_UNITS INTEGER,
+        COMMIT_P50_MS REAL,
+        COMMIT_P95_MS REAL,
+        QUEUE_DEPTH_MEAN REAL,
+        QUEUE_DEPTH_MAX INTEGER)
+    """)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS RUN_TRANSPORT_METRICS(
+        RUN_ID TEXT,
+        POOL_SIZE INTEGER,
+        API_CALLS INTEGER,
+        CONNECTIONS_OPENED INTEGER)
+    """)
+    db.execute("""
+    DELETE FROM RUN_STAGE_METRICS WHERE END_TIME < datetime('now','-1 months')
+    """)
+    for table in RUN_TABLES:
+        db.execute(f"""
+        DELETE FROM {table} WHERE RUN_ID NOT IN (SELECT RUN_ID FROM RUN_STAGE_METRICS)
+        """)
+
+def start_stage(name):
+    # Begin measuring a stage in the current context
+    _current_stage.set(StageMetrics(name))
+
+def finish_stage():
+    # Close the current stage and queue its row for the next flush
+    stage = _current_stage.get()
+    if stage is None:
+        return
+    with _lock:
+        _pending.append(stage.row())
+    _current_stage.set(None)
+
+def bind(function):
+    # Wrap a function submitted to a worker thread so anything it records counts against the submitting stage
+    stage = _current_stage.get()
+
+    def run_in_stage(*args, **kwargs):
+        token = _current_stage.set(stage)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current_stage.reset(token)
+
+    return run_in_stage
+
+def count(counter, amount=1):
+    stage = _current_stage.get() or _run
+    with _lock:
+        stage.counters[counter] += amount
+
+def endpoint_name(url):
+    # API path with IDs replaced, e.g. https://api.spotify.com/v1/playlists/abc/tracks?offset=100 is playlists/{id}/tracks
+    segments = urlsplit(url).path.removeprefix("/v1/").strip("/").split("/")
+    return "/".join(
+        "{id}" if index > 0 and segments[index - 1] in ID_PARENTS else segment
+        for index, segment in enumerate(segments)
+    )
+
+def record_response(response, *args, **kwargs):
+    # requests response hook, counts every API response with its latency and size against the stage and the endpoint called
+    stage = _current_stage.get() or _run
+    latency = response.elapsed.total_seconds()
+    decoded = len(response.content)
+
+    # BYTES_RECEIVED is as sent over the wire in both metrics tables: urllib3 counts the bytes read from the connection before decompression
+    # Responses not read from one (e.g. benchmark fakes) count as decoded
+    tell = getattr(response.raw, "tell", None)
+    received = tell() if tell is not None else decoded
+
+    name = endpoint_name(response.url)
+    with _lock:
+        stage.counters["api_calls"] += 1
+        stage.counters["bytes_received"] += received
+        stage.latencies.append(latency)
+
+        endpoint = _endpoints.get(name)
+        if endpoint is None:
+            endpoint = _endpoints[name] = EndpointMetrics(name)
+        endpoint.calls += 1
+        endpoint.latencies.append(latency)
+        endpoint.bytes_received += received
+        endpoint.bytes_decoded += decoded
+
+def record_component(table, values):
+    # Queue a row of a component's run level metrics for the next flush, values being the table's columns after RUN_ID
+    with _lock:
+        _pending_components.setdefault(table, []).append((RUN_ID, *values))
+
+def flush(db, finish_run=False):
+    # Write queued stage rows with the given connection, optionally closing the run level row and writing the endpoint rows as well
+    with _lock:
+        endpoint_rows = []
+        if finish_run:
+            _pending.append(_run.row())
+            endpoint_rows = [endpoint.row() for endpoint in _endpoints.values()]
+            _endpoints.clear()
+        rows = list(_pending)
+        _pending.clear()
+        component_rows = dict(_pending_components)
+        _pending_components.clear()
+
+    db.executemany(f"""
+        INSERT INTO RUN_STAGE_METRICS
+        VALUES({", ".join("?" * (8 + len(COUNTERS)))})
+    """, rows)
+    db.executemany("""
+        INSERT INTO RUN_ENDPOINT_METRICS
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+    """, endpoint_rows)
+    for table, table_rows in component_rows.items():
+        db.executemany(f"""
+            INSERT INTO {table}
+            VALUES({", ".join("?" * len(table_rows[0]))})
+        """, table_rows)
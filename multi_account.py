@@ -0,0 +1,92 @@
+# Runs the extract for several Spotify accounts, each in its own worker process with its own database
+# Accounts are read from a JSON list of credential profiles, e.g.
+#   [{"name": "lewis", "env_path": "/usr/files/scripts/python/.credentials/lewis.env", "oauth_cache_path": "/usr/files/scripts/python/.credentials/.cache-lewis"}]
+# env_path holds the account's SPOTIPY_* variables. db_path is optional, defaulting to sp_data_<name>.db in DB_FOLDER
+# Every account shares the entity cache (cache.CACHE_PATH), so tracks, albums and artists common to several accounts are only fetched once
+#
+# Example: python multi_account.py --processes 3 --only lewis test
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+
+# Credential profiles, SP_ACCOUNTS_PATH in the environment overrides it
+ACCOUNTS_PATH = os.environ.get("SP_ACCOUNTS_PATH", '/usr/files/scripts/python/.credentials/accounts.json')
+
+# Folder for the per-account databases of profiles without a db_path
+DB_FOLDER = '/usr/files/spotify_data'
+
+# Accounts extracted at the same time. Accounts registered to the same Spotify app share its rate limit, so keep this small
+ACCOUNT_PROCESSES = 2
+
+def load_profiles(accounts_path=ACCOUNTS_PATH):
+    with open(accounts_path) as accounts_file:
+        profiles = json.load(accounts_file)
+
+    for profile in profiles:
+        for key in ("name", "env_path", "oauth_cache_path"):
+            if key not in profile:
+                raise ValueError(f"Account profile {profile} has no {key}")
+    return profiles
+
+def account_environment(profile):
+    # Environment overrides read by utilities (database) and sp_extract_data (credentials, token cache) for one account
+    return {
+        "SP_DB_PATH" : profile.get("db_path", os.path.join(DB_FOLDER, f"sp_data_{profile['name']}.db")),
+        "SP_ENV_PATH" : profile["env_path"],
+        "SP_OAUTH_CACHE_PATH" : profile["oauth_cache_path"]
+    }
+
+def run_account(profile):
+    # Runs in a fresh worker process. The account's credentials replace any inherited ones before the extract modules are imported (they read their paths on import)
+    # Returns the stages logged as failed
+    os.environ.update(account_environment(profile))
+    load_dotenv(profile["env_path"], override=True)
+
+    import sp_extract_data
+    return sp_extract_data.run()
+
+def run_accounts(profiles, processes=ACCOUNT_PROCESSES):
+    # Extract every account, at most processes at a time. Returns {account name: failed stages, or the error that stopped the run}
+    # Each worker process is used for one account only (spawned, not forked), so no module state is shared between accounts
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, max_tasks_per_child=1) as pool:
+        futures = {profile["name"]: pool.submit(run_account, profile) for profile in profiles}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = f"{type(e).__name__}: {e}"
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Spotify extract for several accounts")
+    parser.add_argument("--accounts", default=ACCOUNTS_PATH, help="JSON list of credential profiles")
+    parser.add_argument("--processes", type=int, default=ACCOUNT_PROCESSES, help="accounts extracted at the same time")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="only extract these accounts")
+    args = parser.parse_args()
+
+    profiles = load_profiles(args.accounts)
+    if args.only:
+        unknown = set(args.only) - {profile["name"] for profile in profiles}
+        if unknown:
+            parser.error(f"unknown accounts: {', '.join(sorted(unknown))}")
+        profiles = [profile for profile in profiles if profile["name"] in args.only]
+
+    results = run_accounts(profiles, args.processes)
+
+    failed = False
+    for name, result in results.items():
+        if not result:
+            print(f"{name}: OK")
+        else:
+            failed = True
+            print(f"{name}: FAILED {result if isinstance(result, str) else ', '.join(result)}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import random
+import threading
+import time
+import requests
+import spotipy
+from spotipy.exceptions import SpotifyException
+import metrics
+import transport
+
+# Requests per second the limiter starts at, and the range it adapts within
+INITIAL_RATE = 10.0
+MIN_RATE = 0.5
+MAX_RATE = 50.0
+
+# Requests that can be sent at once after an idle period
+BURST = 10
+
+# On a 429 the rate is multiplied by this, otherwise it climbs back by roughly one request per second every second
+RATE_DECREASE = 0.5
+
+# Retry settings. Backoff is used for 5xx and connection errors, 429s wait for Retry-After (plus jitter) instead
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Retry-After used if a 429 doesn't include one
+DEFAULT_RETRY_AFTER = 1.0
+
+stats = {
+    "calls" : 0,
+    "throttled" : 0,
+    "retried" : 0,
+    "wait_seconds" : 0.0
+}
+_stats_lock = threading.Lock()
+
+def count(stat, amount=1):
+    with _stats_lock:
+        stats[stat] += amount
+
+class RateLimiter:
+    # Token bucket shared by every thread using the client. The refill rate adapts to 429 responses (additive increase, multiplicative decrease)
+
+    def __init__(self, rate=INITIAL_RATE, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        # Wait until a request can be sent. Sleeps happen outside the lock so other threads can update the rate
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+
+            count("wait_seconds", wait)
+            time.sleep(wait)
+
+    def throttled(self, retry_after):
+        # Every thread waits out Retry-After, then continues at the reduced rate
+        # Calls in flight together get their 429s from the same throttle window, so the rate is only cut by the first one to arrive. Later ones can still extend the wait
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.blocked_until:
+                self.rate = max(MIN_RATE, self.rate * RATE_DECREASE)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            self.tokens = 0
+            self.updated = now
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(MAX_RATE, self.rate + 1 / self.rate)
+
+def retry_after_seconds(error):
+    # Retry-After is given in whole seconds by the Spotify API
+    try:
+        return float((error.headers or {}).get("Retry-After", DEFAULT_RETRY_AFTER))
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+def backoff_seconds(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+class RateLimitedSpotify(spotipy.Spotify):
+    # spotipy client where every API call goes through a shared RateLimiter and is retried on throttling or transient errors
+
+    def __init__(self, *args, rate_limiter=None, pool_size=transport.POOL_SIZE, **kwargs):
+        # spotipy's own session retries 429s inside urllib3, which would hide them from the limiter
+        # A pooled session without retries is used unless one is given, so retries only happen here. pool_size should cover the threads making calls
+        if "requests_session" not in kwargs:
+            kwargs["requests_session"] = transport.create_session(pool_size)
+        kwargs.setdefault("requests_timeout", transport.TIMEOUTS)
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter or RateLimiter()
+
+        # Every response is counted in the run metrics
+        self._session.hooks["response"].append(metrics.record_response)
+
+    def _internal_call(self, method, url, payload, params):
+        for attempt in range(MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            count("calls")
+            try:
+                # spotipy can modify params, so each attempt gets a copy
+                result = super()._internal_call(method, url, payload, dict(params))
+
+            except SpotifyException as e:
+                if e.http_status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    raise
+                if e.http_status == 429:
+                    count("throttled")
+                    metrics.count("throttled")
+                    retry_after = retry_after_seconds(e)
+                    self.rate_limiter.throttled(retry_after)
+                    delay = retry_after + random.uniform(0, BACKOFF_BASE)
+                else:
+                    delay = backoff_seconds(attempt)
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = backoff_seconds(attempt)
+
+            else:
+                self.rate_limiter.succeeded()
+                return result
+
+            count("retried")
+            metrics.count("retries")
+            count("wait_seconds", delay)
+            time.sleep(delay)
@@ -0,0 +1,78 @@
+import sys
+
+# Compact records of the API entities the enrichment stages read, holding only the fields stored in the DIM tables
+# Payloads are projected to records as they arrive (or are read from the cache), so the nested JSON of a batch can be released straight away
+# Values repeated across the whole library (types) are interned so each record points at one shared string
+
+class AlbumRecord:
+    # Slots match the payload keys read, so a simplified album embedded in a track can be checked for completeness against them
+    __slots__ = ("id", "name", "album_type", "release_date", "total_tracks")
+
+    def __init__(self, id, name, album_type, release_date, total_tracks):
+        self.id = id
+        self.name = name
+        self.album_type = sys.intern(album_type)
+        self.release_date = release_date
+        self.total_tracks = total_tracks
+
+    @classmethod
+    def from_payload(cls, payload):
+        if payload is None:
+            return None
+        return cls(*(payload[key] for key in cls.__slots__))
+
+    @classmethod
+    def is_complete(cls, payload):
+        return all(key in payload for key in cls.__slots__)
+
+class TrackRecord:
+    # album is the embedded album as a record, or None if the payload's album lacks any field DIM_ALBUMS reads
+    __slots__ = ("id", "name", "artist_id", "album_id", "duration_ms", "popularity", "type", "album")
+
+    def __init__(self, id, name, artist_id, album_id, duration_ms, popularity, type, album=None):
+        self.id = id
+        self.name = name
+        self.artist_id = artist_id
+        self.album_id = album_id
+        self.duration_ms = duration_ms
+        self.popularity = popularity
+        self.type = sys.intern(type)
+        self.album = album
+
+    @classmethod
+    def from_payload(cls, payload):
+        if payload is None:
+            return None
+        album = payload['album']
+        return cls(
+            payload['id'],
+            payload['name'],
+            payload['artists'][0]['id'],
+            album['id'],
+            payload['duration_ms'],
+            payload['popularity'],
+            payload['type'],
+            AlbumRecord.from_payload(album) if AlbumRecord.is_complete(album) else None
+        )
+
+class ArtistRecord:
+    __slots__ = ("id", "name", "type", "popularity")
+
+    def __init__(self, id, name, type, popularity):
+        self.id = id
+        self.name = name
+        self.type = sys.intern(type)
+        self.popularity = popularity
+
+    @classmethod
+    def from_payload(cls, payload):
+        if payload is None:
+            return None
+        return cls(*(payload[key] for key in cls.__slots__))
+
+# Record type each entity type's payloads are projected to
+ENTITY_RECORDS = {
+    "track" : TrackRecord,
+    "album" : AlbumRecord,
+    "artist" : ArtistRecord
+}
@@ -0,0 +1,115 @@
+# Full-text search over the names in DIM_TRACKS, DIM_ALBUMS and DIM_ARTISTS, for looking records up without LIKE '%x%' scans
+# Matching ignores case and diacritics (e.g. "bjork" finds Björk), and every word of a query also matches as a prefix
+#
+# Example: python search.py "beatl abbey"
+import argparse
+import utilities
+
+# Names indexed for each entity type, as {type: (table, id column, name column)}
+SEARCH_SOURCES = {
+    "track" : ("DIM_TRACKS", "TRACK_ID", "TRACK_NAME"),
+    "album" : ("DIM_ALBUMS", "ALBUM_ID", "ALBUM_NAME"),
+    "artist" : ("DIM_ARTISTS", "ARTIST_ID", "ARTIST_NAME")
+}
+
+# Entity types returned by search when none are given
+SEARCH_TYPES = ("album", "artist")
+
+# SEARCH_DOCS holds one row per indexed name, and SEARCH_INDEX indexes it (external content), kept in step by the triggers
+# The DIM tables are rebuilt every run, so the index is built from SEARCH_DOCS rather than from them directly. Its rows only change when a name does
+# Prefix indexes of 2 and 3 characters keep short prefix queries from scanning every term
+SEARCH_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS SEARCH_DOCS(
+        DOC_ID INTEGER PRIMARY KEY,
+        ENTITY_TYPE TEXT NOT NULL,
+        ENTITY_ID TEXT NOT NULL,
+        NAME TEXT,
+        UNIQUE (ENTITY_TYPE, ENTITY_ID))
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS SEARCH_INDEX USING fts5(
+        NAME,
+        ENTITY_TYPE UNINDEXED,
+        ENTITY_ID UNINDEXED,
+        content='SEARCH_DOCS',
+        content_rowid='DOC_ID',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3')
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS SEARCH_DOCS_INSERT AFTER INSERT ON SEARCH_DOCS BEGIN
+        INSERT INTO SEARCH_INDEX (rowid, NAME, ENTITY_TYPE, ENTITY_ID) VALUES (new.DOC_ID, new.NAME, new.ENTITY_TYPE, new.ENTITY_ID);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS SEARCH_DOCS_DELETE AFTER DELETE ON SEARCH_DOCS BEGIN
+        INSERT INTO SEARCH_INDEX (SEARCH_INDEX, rowid, NAME, ENTITY_TYPE, ENTITY_ID) VALUES ('delete', old.DOC_ID, old.NAME, old.ENTITY_TYPE, old.ENTITY_ID);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS SEARCH_DOCS_UPDATE AFTER UPDATE ON SEARCH_DOCS BEGIN
+        INSERT INTO SEARCH_INDEX (SEARCH_INDEX, rowid, NAME, ENTITY_TYPE, ENTITY_ID) VALUES ('delete', old.DOC_ID, old.NAME, old.ENTITY_TYPE, old.ENTITY_ID);
+        INSERT INTO SEARCH_INDEX (rowid, NAME, ENTITY_TYPE, ENTITY_ID) VALUES (new.DOC_ID, new.NAME, new.ENTITY_TYPE, new.ENTITY_ID);
+    END
+    """
+)
+
+def update_index(db):
+    # Bring the index in line with the live DIM tables, touching only names added, changed or removed since the last update. Returns the rows changed
+    # Run after the staging tables are swapped in. An update that fails is caught up by the next, as it compares against the tables rather than tracking changes
+    with utilities.transaction(db):
+        for statement in SEARCH_SCHEMA:
+            db.execute(statement)
+
+        changes = 0
+        for entity_type, (table, id_column, name_column) in SEARCH_SOURCES.items():
+            # rowcount leaves out the index rows written by the triggers, so only names are counted
+            changes += db.execute(f"""
+                DELETE FROM SEARCH_DOCS
+                WHERE ENTITY_TYPE = ?
+                AND NOT EXISTS (SELECT 1 FROM {table} WHERE {id_column} = SEARCH_DOCS.ENTITY_ID)
+            """, (entity_type,)).rowcount
+            changes += db.execute(f"""
+                INSERT INTO SEARCH_DOCS (ENTITY_TYPE, ENTITY_ID, NAME)
+                SELECT ?, {id_column}, {name_column} FROM {table} WHERE true
+                ON CONFLICT (ENTITY_TYPE, ENTITY_ID) DO UPDATE SET NAME = excluded.NAME
+                WHERE NAME IS NOT excluded.NAME
+            """, (entity_type,)).rowcount
+    return changes
+
+def match_query(text):
+    # FTS5 query matching every word of text, each also as a prefix. Words are quoted so punctuation in names (e.g. AC/DC, "Weird Al") isn't read as query syntax
+    words = text.split()
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+def search(db, text, entity_types=SEARCH_TYPES, limit=20):
+    # Names matching every word of text, best match first (bm25), as (entity type, ID, name) tuples
+    query = match_query(text)
+    if not query:
+        return []
+    return db.execute(f"""
+        SELECT ENTITY_TYPE, ENTITY_ID, NAME
+        FROM SEARCH_INDEX
+        WHERE SEARCH_INDEX MATCH ?
+        AND ENTITY_TYPE IN ({", ".join("?" * len(entity_types))})
+        ORDER BY rank
+        LIMIT ?
+    """, (query, *entity_types, limit)).fetchall()
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the names of albums and artists in the extract")
+    parser.add_argument("text", help="words to match, each also as a prefix")
+    parser.add_argument("--types", nargs="+", choices=tuple(SEARCH_SOURCES), default=SEARCH_TYPES, help="entity types to return")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    db = utilities.connect()
+    try:
+        for entity_type, entity_id, name in search(db, args.text, args.types, args.limit):
+            print(f"{entity_type:<8}{entity_id:<24}{name}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,214 +1,413 @@
+# Extract of a Spotify library (liked tracks, top tracks, playlists and their tracks, albums and artists) into SQLite
+# Nothing is connected or requested on import. Run from the command line, or call run() with the stages wanted
+#
+# Example: python sp_extract_data.py top-tracks enrich --force
+# A run that fails or is interrupted leaves its staging tables in place, --resume continues it from the last completed collection or playlist
 # Imports
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from dotenv import load_dotenv 
-import spotipy
+import hashlib
+import os
+import sys
+import threading
 from spotipy.oauth2 import SpotifyOAuth
-import sqlite3
+import async_fetch
+import cache
+import db_writer
+import enrich_pipeline
+import metrics
+import rate_limit
+import records
+import search
+import stage_scheduler
+import token_manager
+import transport
 import utilities
 
-# Declare connection to spotify database
-_db = sqlite3.connect('/usr/files/spotify_data/sp_data.db')
-_c = _db.cursor()
-
-# Initialise Environment variables for connection to spotify
-load_dotenv('/usr/files/scripts/python/.credentials/.env') 
+# Credentials (.env) and OAuth token cache of the account being extracted
+# SP_ENV_PATH and SP_OAUTH_CACHE_PATH in the environment override them, which is how multi_account runs each account
+ENV_PATH = os.environ.get("SP_ENV_PATH", '/usr/files/scripts/python/.credentials/.env')
+OAUTH_CACHE_PATH = os.environ.get("SP_OAUTH_CACHE_PATH", '/usr/files/scripts/python/.credentials/.cache')
 
 # Set scope of spotify access
 scope = "playlist-read-private playlist-read-collaborative user-library-read user-top-read" 
 
-# Connect to API attempting to use cache file. As CMD, follow instructions in putty
-# Authentcates API access using environment variables and scope (environment variables must follow spotipy naming)
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope,open_browser=False,cache_path='/usr/files/scripts/python/.credentials/.cache')) 
-
-# Variables to store user details for later use
-user = sp.current_user()
-user_id = user['id'] 
-user_name = user['display_name']
-
-# Drop existing tables to recreate for multiple data sources (cannot be included in specific function)
-_c.execute("""
-    DROP TABLE IF EXISTS DIM_COLLECTIONS
-    """)
-
-_c.execute("""
-    DROP TABLE IF EXISTS FACT_TRACKS
-    """)
+# Connection to the spotify database and its writer, the spotify client and user details. Set on first use by connect_database and connect_spotify
+_db = None
+_c = None
+_writer = None
+sp = None
+user_id = None
+user_name = None
+_spotify_lock = threading.Lock()
+
+# Connections kept open to the API by the spotify client, set by run to cover the stages running at once
+_pool_size = transport.POOL_SIZE
+
+# Units of work already completed by the interrupted run being resumed, set by connect_database
+completed_units = set()
+
+# Number of playlists fetched at the same time by get_playlists
+PLAYLIST_WORKERS = 4
+
+# When set, get_liked_tracks only reads the liked tracks added since the last run, falling back to a full sync if any were unliked
+LIKED_SYNC_INCREMENTAL = True
+
+# When set, get_playlists only re-fetches playlists whose snapshot has changed since the last run
+PLAYLIST_SYNC_INCREMENTAL = True
+
+# Maximum top tracks kept per time range, None keeps every track the API returns
+# Throttling is handled by rate_limit, so these are only needed if the tail of the list isn't wanted
+TOP_TRACK_LIMITS = {
+    "short_term" : None,
+    "medium_term" : None,
+    "long_term" : None
+}
+
+# Fetch engine used by the enrichment stages. "pipeline" resolves tracks, albums and artists in one overlapping stage (see enrich_pipeline)
+# "sync" and "async" run the three stages one after another, "sync" sending one batch at a time and "async" keeping async_fetch.ENRICH_CONCURRENCY batches in flight
+# Can be chosen per run with SP_ENRICH_ENGINE in the environment or .env file
+ENRICH_ENGINE = os.environ.get("SP_ENRICH_ENGINE", "pipeline")
+
+# spotipy method (also the response key) and the maximum IDs per request for each entity type
+ENTITY_ENDPOINTS = {
+    "track" : ("tracks", 50),
+    "album" : ("albums", 20),
+    "artist" : ("artists", 50)
+}
+
+# Payload keys read from each entity type, which decide the cache TTL applied. Payloads are projected to the records in records.ENTITY_RECORDS
+ENTITY_FIELDS = {
+    "track" : ("id", "name", "artists", "album", "duration_ms", "popularity", "type"),
+    "album" : ("id", "name", "album_type", "release_date", "total_tracks"),
+    "artist" : ("id", "name", "type", "popularity")
+}
+
+# Album records embedded in the track payloads of get_track_info, read by get_albums instead of requesting them again
+track_albums = {}
+
+# Column order of the row tuples inserted into each table
+FACT_TRACKS_COLUMNS = ("TRACK_ID", "COLLECTION_ID", "COLLECTION_POSITION", "COLLECTION_ADDED_DATE")
+DIM_COLLECTIONS_COLUMNS = ("ID", "NAME", "TYPE", "OWNER", "TRACK_COUNT", "PUBLIC", "OWNED")
+DIM_TRACKS_COLUMNS = (
+    "TRACK_ID", "TRACK_NAME", "PRIMARY_ARTIST_ID", "ALBUM_ID", "DURATION_MS", "POPULARITY", "TYPE",
+    "MOST_RECENT_ADDED_DATE", "PLAYLIST_COUNT", "TRACK_RANK", "IS_LIKED")
+DIM_ALBUMS_COLUMNS = ("ALBUM_ID", "ALBUM_NAME", "ALBUM_TYPE", "ALBUM_RELEASE", "TOTAL_TRACKS", "TRACKS_ADDED", "ADDED_PERCENT")
+DIM_ARTISTS_COLUMNS = ("ARTIST_ID", "ARTIST_NAME", "ARTIST_TYPE", "ARTIST_POPULARITY", "TRACKS_ADDED")
+
+# Tables making up the extract, as {table: definition after the table name}
+# Every run builds them as STAGING_ tables and only swaps them in once all stages succeed, so readers never see a partial extract
+TABLE_SCHEMAS = {
+    # Rows are stored in collection order, so replacing a collection's rows touches one range of the table
+    # COLLECTION_TYPE ('liked', 'top' or 'playlist') is derived from the ID so queries filter by type without LIKE scans
+    "FACT_TRACKS" : """(
+        TRACK_ID TEXT,
+        COLLECTION_ID TEXT NOT NULL,
+        COLLECTION_POSITION INTEGER NOT NULL,
+        COLLECTION_ADDED_DATE TEXT,
+        COLLECTION_TYPE TEXT GENERATED ALWAYS AS (
+            CASE
+            WHEN COLLECTION_ID = 'LIKED_TRACKS' THEN 'liked'
+            WHEN COLLECTION_ID LIKE 'TOP_TRACKS%' THEN 'top'
+            ELSE 'playlist'
+            END) VIRTUAL,
+        PRIMARY KEY (COLLECTION_ID, COLLECTION_POSITION))
+        WITHOUT ROWID""",
+    # Snapshot of each playlist as of the last time its tracks were written to FACT_TRACKS
+    "PLAYLIST_STATE" : """(
+        PLAYLIST_ID TEXT PRIMARY KEY,
+        SNAPSHOT_ID TEXT,
+        SYNCED_AT TEXT)""",
+    # Fingerprint of the inputs each skippable stage last ran with, see run_enrichment
+    "STAGE_STATE" : """(
+        STAGE TEXT PRIMARY KEY,
+        INPUT_FINGERPRINT TEXT,
+        COMPLETED_AT TEXT)""",
+    "DIM_COLLECTIONS" : """(
+        ID TEXT PRIMARY KEY,
+        NAME TEXT,
+        OWNER TEXT,
+        TYPE TEXT,
+        TRACK_COUNT INTEGER,
+        PUBLIC INTEGER,
+        OWNED INTEGER)""",
+    "DIM_TRACKS" : """(
+        TRACK_ID TEXT PRIMARY KEY,
+        TRACK_NAME TEXT,
+        PRIMARY_ARTIST_ID TEXT,
+        ALBUM_ID TEXT,
+        DURATION_MS INTEGER,
+        POPULARITY INTEGER,
+        TYPE TEXT,
+        MOST_RECENT_ADDED_DATE TEXT,
+        PLAYLIST_COUNT INTEGER,
+        TRACK_RANK REAL,
+        IS_LIKED INTEGER)""",
+    "DIM_ALBUMS" : """(
+        ALBUM_ID TEXT PRIMARY KEY,
+        ALBUM_NAME TEXT,
+        ALBUM_TYPE TEXT,
+        ALBUM_RELEASE TEXT,
+        TOTAL_TRACKS INTEGER,
+        TRACKS_ADDED INTEGER,
+        ADDED_PERCENT REAL)""",
+    "DIM_ARTISTS" : """(
+        ARTIST_ID TEXT PRIMARY KEY,
+        ARTIST_NAME TEXT,
+        ARTIST_TYPE TEXT,
+        ARTIST_POPULARITY INTEGER,
+        TRACKS_ADDED INTEGER)"""
+}
+
+# Secondary indexes of each table, as {table: {index name: definition after the table name}}
+# FACT_TRACKS_TRACK covers the DIM_TRACKS aggregation (the primary key columns are included in every index of a WITHOUT ROWID table)
+# The partial DIM_TRACKS indexes cover the album and artist counts, which only include tracks in a playlist
+TABLE_INDEXES = {
+    "FACT_TRACKS" : {
+        "FACT_TRACKS_TRACK" : "(TRACK_ID, COLLECTION_TYPE, COLLECTION_ADDED_DATE)"
+    },
+    "DIM_TRACKS" : {
+        "DIM_TRACKS_ALBUM" : "(ALBUM_ID) WHERE PLAYLIST_COUNT IS NOT NULL",
+        "DIM_TRACKS_ARTIST" : "(PRIMARY_ARTIST_ID) WHERE PLAYLIST_COUNT IS NOT NULL"
+    }
+}
+
+# Enrichment is skipped while FACT_TRACKS and DIM_COLLECTIONS are unchanged since it last ran, unless it ran longer ago than this
+# Matches the volatile cache TTL, so popularity is still refreshed as often as the cache allows
+ENRICH_MAX_AGE = timedelta(seconds=cache.FIELD_CLASS_TTLS["volatile"])
+
+def connect_database(resume=False):
+    # Open the spotify database on first use and set up the staging tables
+    # Staging tables start as copies of the live ones, so a run of only some stages keeps everything the other stages wrote. Each stage deletes its own rows before inserting
+    # resume keeps the staging tables of an interrupted run instead, along with its checkpoints. Starts over if there is no run to resume
+    # Stages only read through _db, their writes are queued to _writer, which commits them from its own connection
+    # A failed set up is logged and the connection closed, so the next call starts over
+    global _db, _c, _writer, completed_units
+    if _db is None:
+        start_time = datetime.now()
+        db = utilities.connect()
+        try:
+            resume = resume and utilities.staging_tables_exist(db, TABLE_SCHEMAS)
+            completed_units = utilities.load_checkpoints(db, resume)
+            if resume:
+                # Logged with the units already completed as the record count
+                now = datetime.now()
+                utilities.log_result("RESUMED RUN", now, now, len(completed_units))
+            else:
+                utilities.create_staging_tables(db, TABLE_SCHEMAS, TABLE_SCHEMAS, TABLE_INDEXES)
+        except Exception as e:
+            db.close()
+            utilities.log_result("CONNECT DATABASE", start_time, datetime.now(), 0, f"{type(e).__name__}: {e}")
+            utilities.flush_logs()
+            raise
+        _db = db
+        _c = _db.cursor()
+        _writer = db_writer.DatabaseWriter()
+    return _db
+
+def resumed(unit, script_name):
+    # True if the run being resumed already completed the unit, which is logged as skipped
+    if unit not in completed_units:
+        return False
+    now = datetime.now()
+    utilities.log_result(f"{script_name} (Skipped, completed before resume)", now, now, 0)
+    return True
+
+def connect_spotify():
+    # Authenticate on first use, and store user details for later use
+    # Stages running at the same time wait for the first one to authenticate rather than each starting their own
+    global sp, user_id, user_name
+    with _spotify_lock:
+        if sp is None:
+            # Initialise Environment variables for connection to spotify
+            load_dotenv(ENV_PATH)
+
+            # Connect to API attempting to use cache file. As CMD, follow instructions in putty
+            # Authentcates API access using environment variables and scope (environment variables must follow spotipy naming)
+            # Every call is rate limited and retried on throttling, see rate_limit
+            # Calls share a pool of keep-alive connections, see transport. The token is kept in memory and refreshed in the background, see token_manager
+            client = rate_limit.RateLimitedSpotify(
+                auth_manager=token_manager.TokenManager(SpotifyOAuth(scope=scope,open_browser=False,cache_path=OAUTH_CACHE_PATH)),
+                pool_size=_pool_size)
+
+            user = client.current_user()
+            user_id = user['id']
+            user_name = user['display_name']
+            sp = client
+    return sp
 
 # Functions for each spotify API call
 # Oriented around the API rather than the data / tables to reduce the amount of calls needed (i.e. focus on liked tracks means that liked collections and tracks populated using one call)
-def get_liked_tracks():
+def iter_saved_tracks():
+    # Liked tracks one page at a time (newest first), each item given with the library total
+    # Pages are only requested as the items are consumed, so a caller that stops early saves the remaining requests
+    page_limit = utilities.PAGE_LIMITS["saved_tracks"]
+    offset = 0
+    while True:
+        page = sp.current_user_saved_tracks(limit=page_limit, offset=offset)
+        metrics.count("pages_fetched")
+        for track in page['items']:
+            yield track, page['total']
+
+        if not page['next'] or not page['items']:
+            return
+        offset += len(page['items'])
+
+def get_new_liked_tracks(synced_tracks):
+    # Function to get the (track ID, added date) of each track liked since the last sync, given the synced tracks newest first
+    # Stops at the first synced track, usually on the first page. Returns None if the library total doesn't add up, meaning tracks were unliked and a full sync is needed
+    newest_added_at = synced_tracks[0][1]
+    synced_ids = {track_id for track_id, added_at in synced_tracks}
+
+    new_tracks = []
+    library_total = None
+    for track, library_total in iter_saved_tracks():
+        added_at = track['added_at']
+        if added_at < newest_added_at or (added_at == newest_added_at and track['track']['id'] in synced_ids):
+            break
+        new_tracks.append((track['track']['id'], added_at))
+
+    # Re-liked tracks move to the top, every other synced track should still be in the library
+    new_ids = {track_id for track_id, added_at in new_tracks}
+    expected_total = len(new_tracks) + sum(1 for track_id, added_at in synced_tracks if track_id not in new_ids)
+    if library_total != expected_total:
+        return None
+
+    return new_tracks
+
+def get_liked_tracks(incremental=LIKED_SYNC_INCREMENTAL):
     # Function to get currently liked tracks
+    # incremental only reads tracks liked since the last sync and recomputes positions locally, otherwise the whole library is read
     # Seperate variable to store track count for use in DIM_COLLECTIONS later on, takes record count value from FACT
+    # The stage is checkpointed with the collection row, once both tables are written
     track_count = 0
+    tracks_synced = False
+    if resumed("liked-tracks", "FACT_TRACKS (Liked Tracks)"):
+        return
 
     try:
         # Start by getting list of all tracks and initiating log
         utilities.get_start_info("FACT_TRACKS (Liked Tracks)")
-        record_count = 0
-        tracks = utilities.get_items(sp,sp.current_user_saved_tracks())
+        connect_spotify()
 
-        _c.execute("""
-        CREATE TABLE IF NOT EXISTS FACT_TRACKS(
-            TRACK_ID TEXT,
-            COLLECTION_ID TEXT,
-            COLLECTION_POSITION INTEGER,
-            COLLECTION_ADDED_DATE TEXT)
-        """)
+        # Liked tracks as of the last sync, newest first
+        with utilities.transaction(_db):
+            _c.execute("""
+                SELECT TRACK_ID, COLLECTION_ADDED_DATE
+                FROM STAGING_FACT_TRACKS
+                WHERE COLLECTION_ID = 'LIKED_TRACKS'
+                ORDER BY COLLECTION_POSITION
+            """)
+            synced_tracks = _c.fetchall()
 
+        new_tracks = None
+        if incremental and synced_tracks:
+            new_tracks = get_new_liked_tracks(synced_tracks)
 
-        # For every track
-        for track in tracks:
-            # Get the track info needed for the FACT table (id, source and source details)
-            record_count = record_count + 1
-            TRACK = {
-                "TRACK_ID":(track['track']['id']),
-                "COLLECTION_ID":"LIKED_TRACKS",
-                "COLLECTION_POSITION" : record_count,
-                "COLLECTION_ADDED_DATE" : track['added_at']
-            }
+        if new_tracks is None:
+            # Replace the rows from the previous run
+            # Pages are projected to the FACT table columns (id, source and source details) and queued to the writer as they arrive, so fetching carries on while they are committed
+            # Partial rows are only left in staging if the stage fails, which stops the swap
+            writes = [_writer.write([db_writer.statement("DELETE FROM STAGING_FACT_TRACKS WHERE COLLECTION_ID = 'LIKED_TRACKS'")])]
 
-            # Insert into fact table
-            _c.execute("""
-                    INSERT INTO FACT_TRACKS (
-                        TRACK_ID,
-                        COLLECTION_ID,
-                        COLLECTION_POSITION,
-                        COLLECTION_ADDED_DATE)
-                    VALUES(
-                        :TRACK_ID, 
-                        :COLLECTION_ID,
-                        :COLLECTION_POSITION,
-                        :COLLECTION_ADDED_DATE)  
-                """,TRACK)
-        
-        # Commit changes once all tracks are inserted
-        _db.commit()
+            record_count = 0
+            for page in utilities.iter_pages(sp.current_user_saved_tracks, utilities.PAGE_LIMITS["saved_tracks"]):
+                rows = [
+                    (track['track']['id'], "LIKED_TRACKS", position, track['added_at'])
+                    for position, track in enumerate(page, record_count + 1)
+                ]
+                writes.append(_writer.write([db_writer.insert("STAGING_FACT_TRACKS", FACT_TRACKS_COLUMNS, rows)]))
+                record_count += len(rows)
+            _writer.wait_all(writes)
+
+        elif new_tracks:
+            # New tracks go on top of the synced ones (re-liked tracks only keep their new place), positions are renumbered from 1
+            new_ids = {track_id for track_id, added_at in new_tracks}
+            tracks = new_tracks + [track for track in synced_tracks if track[0] not in new_ids]
+
+            _writer.write([
+                db_writer.statement("DELETE FROM STAGING_FACT_TRACKS WHERE COLLECTION_ID = 'LIKED_TRACKS'"),
+                db_writer.insert(
+                    "STAGING_FACT_TRACKS",
+                    FACT_TRACKS_COLUMNS,
+                    ((track_id, "LIKED_TRACKS", position, added_at) for position, (track_id, added_at) in enumerate(tracks, 1)))
+            ], wait=True)
+            record_count = len(tracks)
+
+        else:
+            # Nothing liked or unliked since the last sync
+            record_count = len(synced_tracks)
 
         # Log finish
         utilities.get_finish_info(record_count)
         track_count = record_count
+        tracks_synced = True
         utilities.write_log()
 
 
     except Exception as e:
         utilities.get_error_message(e.args[0])
         utilities.write_log()
-        _db.commit()
     
     try:
         # Function to store info of collection 
         utilities.get_start_info("DIM_COLLECTION (Liked Tracks)")
-        # Only one collection needed, still logged
-        record_count = 1
-
-        _c.execute("""
-        CREATE TABLE IF NOT EXISTS DIM_COLLECTIONS(
-            ID TEXT,
-            NAME TEXT,
-            OWNER TEXT,
-            TYPE TEXT,
-            TRACK_COUNT INTEGER,
-            PUBLIC INTEGER,
-            OWNED INTEGER)
-        """)
 
+        # Liked tracks collection, everything hardcoded excep the track count and username
+        LIKED_TRACKS = ("LIKED_TRACKS", "Liked Tracks", "preset", user_name, track_count, 0, 1)
 
-        # Create dict of Liked tracks collection, everything hardcoded excep the track count and username
-        LIKED_TRACKS = {
-            "ID": "LIKED_TRACKS",
-            "NAME": "Liked Tracks",
-            "TYPE": "preset",
-            "OWNER": user_name,
-            "TRACK_COUNT": track_count,
-            "PUBLIC": 0,
-            "OWNED": 1
-        }
+        # Insert into dim collections. Only one collection needed, still logged
+        _writer.write([
+            db_writer.statement("DELETE FROM STAGING_DIM_COLLECTIONS WHERE ID = 'LIKED_TRACKS'"),
+            db_writer.insert("STAGING_DIM_COLLECTIONS", DIM_COLLECTIONS_COLUMNS, [LIKED_TRACKS]),
+            *([utilities.checkpoint("liked-tracks")] if tracks_synced else [])
+        ], wait=True)
 
-        # Insert into dim collections
-        _c.execute("""
-                INSERT INTO DIM_COLLECTIONS (
-                    ID,
-                    NAME,
-                    TYPE, 
-                    OWNER, 
-                    TRACK_COUNT,
-                    PUBLIC, 
-                    OWNED)
-                VALUES(
-                    :ID, 
-                    :NAME, 
-                    :TYPE, 
-                    :OWNER,
-                    :TRACK_COUNT, 
-                    :PUBLIC, 
-                    :OWNED)  
-            """,LIKED_TRACKS)   
-        _db.commit()
-
-        utilities.get_finish_info(record_count)
+        utilities.get_finish_info(1)
         utilities.write_log()
 
     except Exception as e:
         utilities.get_error_message(e.args[0])
         utilities.write_log()
 
-        _db.commit()
-
 def get_top_tracks(time_range):
     # Function to get top tracks, follows liked tracks pattern only uses parameter for time range parameter in API
     # Minor alterations need seperate function despite close pattenr
     track_count = 0
+    tracks_synced = False
+    unit = f"top-tracks:{time_range}"
+    if resumed(unit, f"FACT_TRACKS (Top Tracks - {time_range})"):
+        return
     
     try:
         utilities.get_start_info(f"FACT_TRACKS (Top Tracks - {time_range})")
-        record_count = 0
-        # Limit set to 50 as defaults to 20, but 50 max. Reduces calls needed
-        tracks = utilities.get_items(sp,sp.current_user_top_tracks(limit=50, time_range=time_range))
-
-        _c.execute("""
-        CREATE TABLE IF NOT EXISTS FACT_TRACKS(
-            TRACK_ID TEXT,
-            COLLECTION_ID TEXT,
-            COLLECTION_POSITION INTEGER,
-            COLLECTION_ADDED_DATE TEXT)
-        """)
-
-        # Rate limit was often exceeded due to amount of top tracks included, limited to avoid this
-        # Also after a certain amount, data became meaningless. Mightve included every track ever listened to in long_term
-        track_limit = 0
-        match time_range:
-            case "short_term":
-                track_limit = 250
-            case "medium_term":
-                track_limit = 500
-            case "long_term":
-                track_limit = 1000
-
-        tracks = tracks[:track_limit]
-
-        for track in tracks:
-            record_count = record_count + 1
+        connect_spotify()
+        # Tracks were previously capped at 250 / 500 / 1000 as the rate limit was often exceeded, now set in TOP_TRACK_LIMITS
+        # Pages past the limit are never requested
+        track_limit = TOP_TRACK_LIMITS.get(time_range)
 
-            TRACK = {
-                "TRACK_ID":(track['id']),
-                "COLLECTION_ID":f"TOP_TRACKS_{time_range}",
-                "COLLECTION_POSITION":(record_count)
-            }
+        # Replace the rows from the previous run, queueing each page to the writer as it arrives (as for liked tracks). Top tracks have no added date
+        writes = [_writer.write([db_writer.statement("DELETE FROM STAGING_FACT_TRACKS WHERE COLLECTION_ID = ?", (f"TOP_TRACKS_{time_range}",))])]
 
-            _c.execute("""
-                    INSERT INTO FACT_TRACKS (
-                        TRACK_ID,
-                        COLLECTION_ID,
-                        COLLECTION_POSITION)
-                    VALUES(
-                        :TRACK_ID, 
-                        :COLLECTION_ID,
-                        :COLLECTION_POSITION)  
-                """,TRACK)
-        
-        _db.commit()
+        record_count = 0
+        # Limit set to 50 as defaults to 20, but 50 max. Reduces calls needed
+        for page in utilities.iter_pages(
+            lambda limit, offset: sp.current_user_top_tracks(limit=limit, offset=offset, time_range=time_range),
+            utilities.PAGE_LIMITS["top_tracks"],
+            track_limit):
+            rows = [
+                (track['id'], f"TOP_TRACKS_{time_range}", position, None)
+                for position, track in enumerate(page, record_count + 1)
+            ]
+            writes.append(_writer.write([db_writer.insert("STAGING_FACT_TRACKS", FACT_TRACKS_COLUMNS, rows)]))
+            record_count += len(rows)
+        _writer.wait_all(writes)
         
         utilities.get_finish_info(record_count)
         track_count = record_count
+        tracks_synced = True
         utilities.write_log()
 
     
@@ -216,577 +415,621 @@ def get_top_tracks(time_range):
         utilities.get_error_message(e.args[0])
         utilities.write_log()
 
-        _db.commit()
-
     try:
         utilities.get_start_info(f"DIM_COLLECTION (Top Tracks - {time_range})")
-        record_count = 1
-
-        _c.execute("""
-        CREATE TABLE IF NOT EXISTS DIM_COLLECTIONS(
-            ID TEXT,
-            NAME TEXT,
-            OWNER TEXT,
-            TYPE TEXT,
-            TRACK_COUNT INTEGER,
-            PUBLIC INTEGER,
-            OWNED INTEGER)
-        """)
 
-        TOP_TRACKS = {
-            "ID": f"TOP_TRACKS_{time_range}",
-            "NAME": f"Top Tracks - {time_range}",
-            "TYPE": "preset",
-            "OWNER": user_name,
-            "TRACK_COUNT": track_count,
-            "PUBLIC": 0,
-            "OWNED": 1
-        }
+        TOP_TRACKS = (f"TOP_TRACKS_{time_range}", f"Top Tracks - {time_range}", "preset", user_name, track_count, 0, 1)
 
-        _c.execute("""
-                INSERT INTO DIM_COLLECTIONS (
-                    ID,
-                    NAME,
-                    TYPE, 
-                    OWNER, 
-                    TRACK_COUNT,
-                    PUBLIC, 
-                    OWNED)
-                VALUES(
-                    :ID, 
-                    :NAME, 
-                    :TYPE, 
-                    :OWNER,
-                    :TRACK_COUNT, 
-                    :PUBLIC, 
-                    :OWNED)  
-            """,TOP_TRACKS)
-        
-        _db.commit()
+        _writer.write([
+            db_writer.statement("DELETE FROM STAGING_DIM_COLLECTIONS WHERE ID = ?", (TOP_TRACKS[0],)),
+            db_writer.insert("STAGING_DIM_COLLECTIONS", DIM_COLLECTIONS_COLUMNS, [TOP_TRACKS]),
+            *([utilities.checkpoint(unit)] if tracks_synced else [])
+        ], wait=True)
 
-        utilities.get_finish_info(record_count)
+        utilities.get_finish_info(1)
         utilities.write_log()
 
     except Exception as e:
         utilities.get_error_message(e.args[0])
         utilities.write_log()
 
-        _db.commit()
-
-def get_playlists():
+def get_playlists(max_workers=PLAYLIST_WORKERS, incremental=PLAYLIST_SYNC_INCREMENTAL):
     # Function to get playlist. Reverse pattern to Liked and Top, gets collections first as API doesnt give tracks immediately
+    # max_workers sets how many playlists have their tracks fetched at the same time
+    # incremental skips playlists whose snapshot_id matches PLAYLIST_STATE, otherwise every playlist is fetched
 
-    # List to store playlist IDs for later use
+    # List to store playlist IDs for later use, and each playlist's current snapshot
     playlist_ids = []
+    playlist_snapshots = {}
+    playlists_listed = False
     try:
         # Function to get all playlist info, standard collection process
         utilities.get_start_info("DIM_COLLECTIONS (Playlists)")
-        record_count = 0
-
-        _c.execute("""
-        CREATE TABLE IF NOT EXISTS DIM_COLLECTIONS(
-            ID TEXT,
-            NAME TEXT,
-            OWNER TEXT,
-            TYPE TEXT,
-            TRACK_COUNT INTEGER,
-            PUBLIC INTEGER,
-            OWNED INTEGER)
-        """)
-
-        playlists = utilities.get_items(sp,sp.current_user_playlists())
+        connect_spotify()
+
+        # The playlists endpoint doesn't accept a fields filter, so each page is projected to DIM_COLLECTIONS rows and snapshots as it arrives
+        # Offset pages can repeat a playlist if the list changes while it is read, each playlist is only kept once
+        rows = {}
+        for page in utilities.iter_pages(sp.current_user_playlists, utilities.PAGE_LIMITS["playlists"]):
+            for playlist in page:
+                playlist_snapshots[playlist['id']] = playlist['snapshot_id']
+                rows[playlist['id']] = (
+                    playlist['id'],
+                    playlist['name'],
+                    playlist['type'],
+                    playlist['owner']['display_name'],
+                    playlist['tracks']['total'],
+                    1 if playlist['public'] == True else 0,
+                    1 if playlist['owner']['display_name'] == user_name else 0
+                )
+
+        playlist_ids = list(rows)
+        rows = list(rows.values())
+
+        # Every playlist row is replaced, the preset collections are left to their own stages
+        _writer.write([
+            db_writer.statement("DELETE FROM STAGING_DIM_COLLECTIONS WHERE TYPE != 'preset'"),
+            db_writer.insert("STAGING_DIM_COLLECTIONS", DIM_COLLECTIONS_COLUMNS, rows)
+        ], wait=True)
+        playlists_listed = True
+
+        utilities.get_finish_info(len(rows))
+        utilities.write_log()
 
-        for playlist in playlists:
+    except Exception as e:
+        utilities.get_error_message(e.args[0])
+        utilities.write_log()
 
-            playlist_ids.append(playlist['id'])
+    # Sync is only safe against a complete playlist list, otherwise every playlist would look deleted
+    if not playlists_listed:
+        return
 
-            PLAYLIST = {
-                "ID": playlist['id'],
-                "NAME": playlist['name'],
-                "TYPE": playlist['type'],
-                "OWNER": playlist['owner']['display_name'],
-                "TRACK_COUNT": playlist['tracks']['total'],
-                "PUBLIC": 1 if playlist['public'] == True else 0,
-                "OWNED": 1 if playlist['owner']['display_name'] == user_name else 0
-            }
+    try:
+        utilities.get_start_info("PLAYLIST_STATE (Playlists)")
+
+        # Remove rows for playlists that no longer exist (any collection not listed this run and not a preset)
+        _writer.write([
+            db_writer.statement("""
+                DELETE FROM STAGING_FACT_TRACKS
+                WHERE COLLECTION_ID NOT IN (SELECT ID FROM STAGING_DIM_COLLECTIONS)
+                AND COLLECTION_TYPE = 'playlist'
+            """),
+            db_writer.statement("""
+                DELETE FROM STAGING_PLAYLIST_STATE
+                WHERE PLAYLIST_ID NOT IN (SELECT ID FROM STAGING_DIM_COLLECTIONS)
+            """)
+        ], wait=True)
 
-            record_count = record_count + 1
+        # Only new playlists and playlists with a different snapshot need their tracks fetched
+        if incremental:
+            with utilities.transaction(_db):
+                _c.execute("SELECT PLAYLIST_ID, SNAPSHOT_ID FROM STAGING_PLAYLIST_STATE")
+                synced_snapshots = dict(_c.fetchall())
+            playlist_ids = [id for id in playlist_ids if synced_snapshots.get(id) != playlist_snapshots[id]]
 
-            _c.execute("""
-                    INSERT INTO DIM_COLLECTIONS (
-                        ID,
-                        NAME,
-                        TYPE, 
-                        OWNER, 
-                        TRACK_COUNT,
-                        PUBLIC, 
-                        OWNED)
-                    VALUES(
-                        :ID, 
-                        :NAME, 
-                        :TYPE, 
-                        :OWNER,
-                        :TRACK_COUNT, 
-                        :PUBLIC, 
-                        :OWNED)  
-                """,PLAYLIST)
-        
-        _db.commit()
+        # Playlists already written by the run being resumed are skipped too, unless they changed since
+        playlist_ids = [id for id in playlist_ids if f"playlist:{id}:{playlist_snapshots[id]}" not in completed_units]
 
-        utilities.get_finish_info(record_count)
+        utilities.get_finish_info(len(playlist_ids))
         utilities.write_log()
 
     except Exception as e:
         utilities.get_error_message(e.args[0])
         utilities.write_log()
-
-        _db.commit()
+        return
 
     try:
         utilities.get_start_info("FACT_TRACKS (Playlists)")
-
-        # Iterates through each playlist ID, gets each playlist tracks then iterates through that
-        for id in playlist_ids:
-            record_count = 0
-            tracks = (utilities.get_items(sp,sp.playlist(id)['tracks']))
-
-            for track in tracks:
-                record_count = record_count + 1
-
-                # For some playlists, some tracks are considered NONE which throws exception unless handled
-                if track['track'] is not None:
-                    TRACK = {
-                        "TRACK_ID": (track['track']['id']),
-                        "COLLECTION_ID":id,
-                        "COLLECTION_POSITION":(record_count),
-                        "COLLECTION_ADDED_DATE": track['added_at']
-                    }
-
-                    _c.execute("""
-                        INSERT INTO FACT_TRACKS (
-                            TRACK_ID,
-                            COLLECTION_ID,
-                            COLLECTION_POSITION,
-                            COLLECTION_ADDED_DATE)
-                        VALUES(
-                            :TRACK_ID, 
-                            :COLLECTION_ID,
-                            :COLLECTION_POSITION,
-                            :COLLECTION_ADDED_DATE)  
-                    """,TRACK)
-        
-        _db.commit()
-        utilities.get_finish_info(record_count)
+        total_count = 0
+
+        # Playlists are fetched at the same time, limited by max_workers. map keeps the results in playlist order
+        # Each playlist's rows are queued to the writer as its result arrives, the workers carry on fetching while they are committed
+        writes = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for id, result in zip(playlist_ids, pool.map(metrics.bind(get_playlist_tracks), playlist_ids)):
+                start_time, end_time, rows, record_count, error_message = result
+
+                # Each playlist is logged on its own so one failure doesn't stop the rest
+                if error_message is not None:
+                    utilities.log_result(f"FACT_TRACKS (Playlist - {id})", start_time, end_time, 0, error_message)
+                    continue
+
+                # Replace the playlist's rows from the previous sync
+                # Snapshot and checkpoint are written in the same unit as the rows, so a failed playlist is retried next run
+                writes.append((id, start_time, end_time, record_count, _writer.write([
+                    db_writer.statement("DELETE FROM STAGING_FACT_TRACKS WHERE COLLECTION_ID = ?", (id,)),
+                    db_writer.insert("STAGING_FACT_TRACKS", FACT_TRACKS_COLUMNS, rows),
+                    db_writer.statement("""
+                        INSERT OR REPLACE INTO STAGING_PLAYLIST_STATE (PLAYLIST_ID, SNAPSHOT_ID, SYNCED_AT)
+                        VALUES (?, ?, ?)
+                    """, (id, playlist_snapshots[id], end_time)),
+                    utilities.checkpoint(f"playlist:{id}:{playlist_snapshots[id]}")
+                ])))
+
+        # Playlists are logged once their rows are committed. Only a failing playlist's own rows are rolled back
+        _writer.flush()
+        for id, start_time, end_time, record_count, write in writes:
+            try:
+                write.result()
+                total_count = total_count + record_count
+                utilities.log_result(f"FACT_TRACKS (Playlist - {id})", start_time, end_time, record_count)
+
+            except Exception as e:
+                utilities.log_result(f"FACT_TRACKS (Playlist - {id})", start_time, end_time, 0, e.args[0])
+
+        utilities.get_finish_info(total_count)
         utilities.write_log()
 
     except Exception as e:
         utilities.get_error_message(e.args[0])
         utilities.write_log()
 
-        _db.commit()
+def get_playlist_tracks(playlist_id):
+    # Worker function for get_playlists. Returns timings with either the FACT rows and track count or the error message so the caller can log each playlist
+    # Only track IDs and added dates are requested (PAGE_FIELDS), at the maximum page size
+    # Each page is projected to rows as it arrives
+    start_time = datetime.now()
+    try:
+        rows = []
+        record_count = 0
+        for page in utilities.iter_pages(
+            lambda limit, offset: sp.playlist_items(
+                playlist_id, fields=utilities.PAGE_FIELDS["playlist_items"], limit=limit, offset=offset, additional_types=("track",)),
+            utilities.PAGE_LIMITS["playlist_items"]):
+            # For some playlists, some tracks are considered NONE which throws exception unless handled
+            # Podcast episodes are skipped too, the tracks endpoint has nothing for their IDs
+            # Position still counts them so positions match the playlist
+            rows.extend(
+                (track['track']['id'], playlist_id, position, track['added_at'])
+                for position, track in enumerate(page, record_count + 1)
+                if track['track'] is not None and track['track'].get('type', 'track') == 'track'
+            )
+            record_count += len(page)
+        return start_time, datetime.now(), rows, record_count, None
 
-def get_track_info():
+    except Exception as e:
+        return start_time, datetime.now(), None, 0, e.args[0]
+
+def get_fetch_batch(entity_type):
+    # Function fetching one batch of IDs of an entity type (up to the endpoint's maximum), returning payloads in the order requested
+    # Keys never stored (market lists, images) are dropped on arrival, so batches waiting to be cached and projected stay small
+    endpoint = ENTITY_ENDPOINTS[entity_type][0]
+
+    def fetch_batch(ids):
+        return [cache.strip_payload(payload) for payload in getattr(sp, endpoint)(ids)[endpoint]]
+
+    return fetch_batch
+
+def get_entities(entity_type, ids, engine):
+    # Get a record for each ID through the cache, sending misses to the API with the selected engine
+    # Payloads are projected to records as each batch is cached, None for entities the API didn't return
+    batch_size = ENTITY_ENDPOINTS[entity_type][1]
+    fetch_batch = get_fetch_batch(entity_type)
+
+    fetch_batches = None
+    if engine == "async":
+        fetch_batches = lambda id_batches: async_fetch.fetch_batches(fetch_batch, id_batches)
+
+    return cache.get_many(
+        entity_type, ids, fetch_batch, batch_size, ENTITY_FIELDS[entity_type], fetch_batches, records.ENTITY_RECORDS[entity_type].from_payload)
+
+def get_track_metrics():
+    # Query to return each unique track ID, in one pass over FACT_TRACKS_TRACK grouped by track (collections are looked up by primary key)
+    # Also return the most recently added date to a collection (if available)
+    # Also return the count of private playlists that the track is added to. Private is used to distinguished shared and none shared playlists to avoid corruption of friends bad taste
+    # Also return a metric based on track position in top list if existing in list. Combines positiioning and prioritises the longest term list by weighting.
+    # Top list lengths come from DIM_COLLECTIONS rather than a window over the fact rows
+    _c.execute("""
+        SELECT
+            ft.TRACK_ID,
+            MIN(ft.COLLECTION_ADDED_DATE) AS MOST_RECENT_ADDED_DATE,
+            NULLIF(SUM(ft.COLLECTION_TYPE = 'playlist' AND dc.PUBLIC = 0 AND dc.NAME != "Autism"), 0) AS PLAYLIST_COUNT,
+            SUM(CASE WHEN ft.COLLECTION_TYPE = 'top' THEN
+                (1 - (ft.COLLECTION_POSITION * 1.0) / dc.TRACK_COUNT) *
+                CASE ft.COLLECTION_ID
+                WHEN 'TOP_TRACKS_long_term' THEN 0.8
+                WHEN 'TOP_TRACKS_medium_term' THEN 0.4
+                WHEN 'TOP_TRACKS_short_term' THEN 0.2
+                END
+            END) AS TRACK_RANK,
+            MAX(CASE WHEN ft.COLLECTION_TYPE = 'liked' THEN 1 END) AS IS_LIKED
+        FROM STAGING_FACT_TRACKS AS ft
+        LEFT JOIN STAGING_DIM_COLLECTIONS AS dc ON ft.COLLECTION_ID = dc.ID
+        GROUP BY ft.TRACK_ID
+    """)
+    return _c.fetchall()
+
+def track_row(track, api_track):
+    # DIM_TRACKS row from a get_track_metrics row and the track's record
+    # Keyed by the ID stored in FACT_TRACKS, which is what every other table joins on
+    track_id, most_recent_added_date, playlist_count, track_rank, is_liked = track
+    return (
+        track_id,
+        api_track.name,
+        api_track.artist_id,
+        api_track.album_id,
+        api_track.duration_ms,
+        api_track.popularity,
+        api_track.type,
+        most_recent_added_date,
+        playlist_count,
+        track_rank,
+        is_liked
+    )
+
+def embedded_albums(api_tracks):
+    # Track payloads include a simplified album with the same fields DIM_ALBUMS reads, so albums are taken from the tracks rather than requested again
+    # Returns {album ID: album record} for the complete albums (see records.TrackRecord), anything incomplete is left to the albums endpoint
+    return {api_track.album.id: api_track.album for api_track in api_tracks if api_track is not None and api_track.album is not None}
+
+def log_missing(entity_type, ids):
+    # The API returns null for IDs it no longer has (e.g. tracks removed from Spotify). They are left out of the DIM tables rather than failing the stage
+    # Nulls aren't cached, so they are requested again next run. Logged with the count, as MISSING TRACKS etc.
+    if ids:
+        now = datetime.now()
+        utilities.log_result(f"MISSING {entity_type.upper()}S", now, now, len(ids))
+
+def album_row(album_id, tracks_added, api_album):
+    return (
+        album_id,
+        api_album.name,
+        api_album.album_type,
+        api_album.release_date,
+        api_album.total_tracks,
+        tracks_added,
+        tracks_added/api_album.total_tracks
+    )
+
+def artist_row(artist_id, tracks_added, api_artist):
+    return (
+        artist_id,
+        api_artist.name,
+        api_artist.type,
+        api_artist.popularity,
+        tracks_added
+    )
+
+def get_track_info(engine=ENRICH_ENGINE):
     # Function to iterate through all distinct tracks populated in the fact tables
 
     try:
-        _c.execute("""
-        DROP TABLE IF EXISTS DIM_TRACKS
-        """)
-
-        _c.execute("""
-            CREATE TABLE IF NOT EXISTS DIM_TRACKS(
-                TRACK_ID TEXT,
-                TRACK_NAME TEXT,
-                PRIMARY_ARTIST_ID TEXT,
-                ALBUM_ID TEXT,
-                DURATION_MS INTEGER,
-                POPULARITY INTEGER,
-                TYPE TEXT,
-                MOST_RECENT_ADDED_DATE TEXT,
-                PLAYLIST_COUNT INTEGER,
-                TRACK_RANK REAL,
-                IS_LIKED INTEGER)
-            """)
         # Start by getting list of all unuique tracks and initiating log
         utilities.get_start_info("DIM_TRACKS")
-        record_count = 0
+        connect_spotify()
 
-        # Query to return each unique track ID
-        # Also return the most recently added date to a collection (if available)
-        # Also return the count of private playlists that the track is added to. Private is used to distinguished shared and none shared playlists to avoid corruption of friends bad taste
-        # Also return a metric based on track position in top list if existing in list. Combines positiioning and prioritises the longest term list by weighting. 
-        _c.execute("""
-            WITH 
-            TRACK_LIST AS 
-            (SELECT DISTINCT TRACK_ID, MIN(COLLECTION_ADDED_DATE) AS MOST_RECENT_ADDED_DATE
-            FROM FACT_TRACKS GROUP BY TRACK_ID),
-            PLAYLIST_COUNT AS
-            (SELECT DISTINCT TRACK_ID, COUNT(COLLECTION_ID) AS PLAYLIST_COUNT, NAME
-            FROM FACT_TRACKS AS ft
-            INNER JOIN DIM_COLLECTIONS AS dc ON ft.COLLECTION_ID = dc.ID
-            WHERE COLLECTION_ID NOT LIKE "TOP_TRACKS%" AND COLLECTION_ID != "LIKED_TRACKS" AND PUBLIC = 0 AND NAME != "Autism"
-            GROUP BY TRACK_ID),
-            TRACK_RANK AS
-            (SELECT TRACK_ID, (SUM(TRACK_RANK) * COLLECTION_WEIGHT) AS TRACK_RANK
-            FROM
-            (
-            SELECT 
-                TRACK_ID, 
-                1-((COLLECTION_POSITION*1.0) / (COUNT(*) OVER (PARTITION BY COLLECTION_ID))*1.0) AS TRACK_RANK,
-                CASE COLLECTION_ID
-                WHEN 'TOP_TRACKS_long_term' THEN 0.8
-                WHEN 'TOP_TRACKS_medium_term' THEN 0.4
-                WHEN 'TOP_TRACKS_short_term' THEN 0.2
-                END AS COLLECTION_WEIGHT
-            FROM FACT_TRACKS
-            WHERE COLLECTION_ID LIKE "TOP_TRACKS%")
-            GROUP BY TRACK_ID),
-            IS_LIKED AS
-            (SELECT TRACK_ID, 1 AS IS_LIKED
-            FROM FACT_TRACKS
-            WHERE COLLECTION_ID = 'LIKED_TRACKS')
-
-            SELECT tl.TRACK_ID, tl.MOST_RECENT_ADDED_DATE, pc.PLAYLIST_COUNT, tr.TRACK_RANK, il.IS_LIKED
-            FROM TRACK_LIST AS tl
-            LEFT JOIN PLAYLIST_COUNT AS pc ON tl.TRACK_ID = pc.TRACK_ID
-            LEFT JOIN TRACK_RANK AS tr ON tl.TRACK_ID = tr.TRACK_ID
-            LEFT JOIN IS_LIKED AS il ON tl.TRACK_ID = il.TRACK_ID
-        """)
-        tracks = _c.fetchall()
-
-        # API handles tracks 50 (max) at a time. Chunk SQL result into 50s
-        tracks_chunks = (list(utilities.chunk_list(tracks,50)))
-
-
-        for tracks_chunk in tracks_chunks:
-            chunk_ids = []
-            chunk_base_track_details = []
-            chunk_api_track_details = []
-
-            # Iterates through each chunks. Gets ID and also gets query metrics
-            for track in tracks_chunk:
-                track_id = track[0]
-                # Build list of 50 ids for the API
-                chunk_ids.append(track_id)
-                most_recent_added_date = track[1]
-                playlist_count = track[2]
-                track_rank = track[3]
-                is_liked = track[4]
-
-                # Builds dict with info gathered from SQL query result
-                BASE_TRACK_DETAILS = {
-                    "TRACK_ID" : track_id,
-                    "MOST_RECENT_ADDED_DATE" : most_recent_added_date,
-                    "PLAYLIST_COUNT" : playlist_count,
-                    "TRACK_RANK" : track_rank,
-                    "IS_LIKED" : is_liked
-                } 
-
-                # Add the dict to a list of track details specific to SQL results
-                chunk_base_track_details.append(BASE_TRACK_DETAILS)
-            
-            # Get API results using list of IDS, no need for get items utility as already chunked to limit
-            tracks = (sp.tracks(chunk_ids))['tracks']
-            
-            for track in tracks:
-                track_id = track['id']
-                track_name = track['name']
-                primary_artist_id = track['artists'][0]['id']
-                album_id = track['album']['id']
-                duration_ms = track['duration_ms']
-                popularity = track['popularity']
-                type = track['type']
-
-                # Build dict for results from API
-                API_TRACK_DETAILS = {
-                    "TRACK_ID" : track_id,
-                    "TRACK_NAME" : track_name,
-                    "PRIMARY_ARTIST_ID" : primary_artist_id,
-                    "ALBUM_ID" : album_id,
-                    "DURATION_MS" : duration_ms,
-                    "POPULARITY" : popularity,
-                    "TYPE" : type
-                }
-
-                # Add the dict to a list of track details specific to API results
-                chunk_api_track_details.append(API_TRACK_DETAILS)
-            
-            for i in range(len(chunk_ids)):
-                # For loop iterating through lenght of the current chunk
-
-                # Build a combined track dict
-                TRACK_DETAILS = {
-                    "TRACK_ID" : chunk_api_track_details[i]['TRACK_ID'],
-                    "TRACK_NAME" : chunk_api_track_details[i]['TRACK_NAME'],
-                    "PRIMARY_ARTIST_ID" : chunk_api_track_details[i]['PRIMARY_ARTIST_ID'],
-                    "ALBUM_ID" : chunk_api_track_details[i]['ALBUM_ID'],
-                    "DURATION_MS" : chunk_api_track_details[i]['DURATION_MS'],
-                    "POPULARITY" : chunk_api_track_details[i]['POPULARITY'],
-                    "TYPE" : chunk_api_track_details[i]['TYPE'],
-                    "MOST_RECENT_ADDED_DATE" : chunk_base_track_details[i]['MOST_RECENT_ADDED_DATE'],
-                    "PLAYLIST_COUNT" : chunk_base_track_details[i]['PLAYLIST_COUNT'],
-                    "TRACK_RANK" : chunk_base_track_details[i]['TRACK_RANK'],
-                    "IS_LIKED" : chunk_base_track_details[i]['IS_LIKED']
-                }
-
-                record_count += 1
-
-                # Insert into track details table
-                _c.execute("""
-                    INSERT INTO DIM_TRACKS (
-                        TRACK_ID,
-                        TRACK_NAME,
-                        PRIMARY_ARTIST_ID, 
-                        ALBUM_ID, 
-                        DURATION_MS,
-                        POPULARITY, 
-                        TYPE,
-                        MOST_RECENT_ADDED_DATE, 
-                        PLAYLIST_COUNT,
-                        TRACK_RANK, 
-                        IS_LIKED)
-                    VALUES(
-                        :TRACK_ID,
-                        :TRACK_NAME,
-                        :PRIMARY_ARTIST_ID, 
-                        :ALBUM_ID, 
-                        :DURATION_MS,
-                        :POPULARITY, 
-                        :TYPE,
-                        :MOST_RECENT_ADDED_DATE, 
-                        :PLAYLIST_COUNT,
-                        :TRACK_RANK, 
-                        :IS_LIKED)  
-                """,TRACK_DETAILS)
-
-        _db.commit()
+        tracks = get_track_metrics()
 
-        utilities.get_finish_info(record_count)
+        # Get a record for every track through the cache. Only missing or expired tracks are requested, 50 (max) at a time
+        api_tracks = get_entities("track", [track[0] for track in tracks], engine)
+
+        # Combine API results with the query metrics, API returns tracks in the order requested
+        rows = [track_row(track, api_track) for track, api_track in zip(tracks, api_tracks) if api_track is not None]
+        log_missing("track", [track[0] for track, api_track in zip(tracks, api_tracks) if api_track is None])
+
+        # Albums are kept for get_albums
+        track_albums.update(embedded_albums(api_tracks))
+
+        # Insert into track details table
+        _writer.write([
+            db_writer.statement("DELETE FROM STAGING_DIM_TRACKS"),
+            db_writer.insert("STAGING_DIM_TRACKS", DIM_TRACKS_COLUMNS, rows)
+        ], wait=True)
+
+        utilities.get_finish_info(len(rows))
         utilities.write_log() 
 
     except Exception as e:
         utilities.get_error_message(e.args[0])
         utilities.write_log()
 
-        _db.commit()
-
-def get_albums():
+def get_albums(engine=ENRICH_ENGINE):
      # Function to iterate through all distinct albums populated in the fact tables. Chunked into max API allowance similar to tracks function
     try:
-        _c.execute("""
-        DROP TABLE IF EXISTS DIM_ALBUMS
-        """)
-
-        _c.execute("""
-            CREATE TABLE IF NOT EXISTS DIM_ALBUMS(
-                ALBUM_ID TEXT,
-                ALBUM_NAME TEXT,
-                ALBUM_TYPE TEXT,
-                ALBUM_RELEASE TEXT,
-                TOTAL_TRACKS INTEGER,
-                TRACKS_ADDED INTEGER,
-                ADDED_PERCENT REAL)
-            """)
-        
         # Start by getting list of all unique albums and the count of tracks from each album stored in playlist
         utilities.get_start_info("DIM_ALBUMS")
-        record_count = 0
+        connect_spotify()
 
         # Query to return each unique album ID
         # Also return the count of tracks from each album stored
         _c.execute("""
-            SELECT ALBUM_ID, COUNT(TRACK_ID) 
-            FROM DIM_TRACKS
+            SELECT ALBUM_ID, COUNT(*)
+            FROM STAGING_DIM_TRACKS
             WHERE PLAYLIST_COUNT IS NOT NULL
             GROUP BY ALBUM_ID
         """)
 
         albums = _c.fetchall()
-        albums_chunks = (list(utilities.chunk_list(albums,20)))
-
-        for albums_chunk in albums_chunks:
-            chunk_ids = []
-            chunk_base_album_details = []
-            chunk_api_album_details = []
-
-            for album in albums_chunk:
-
-                # Build album details dict from sql results and api
-                ALBUM_BASE_DETAILS = {
-                    "ALBUM_ID": album[0],
-                    "TRACKS_ADDED": album[1]
-                }
-
-                chunk_base_album_details.append(ALBUM_BASE_DETAILS)
-                chunk_ids.append(album[0])
-
-            albums = sp.albums(chunk_ids)['albums']
-
-            for album in albums:
-                ALBUM_API_DETAILS = {
-                    "ALBUM_ID": album['id'],
-                    "ALBUM_NAME": album['name'],
-                    "ALBUM_TYPE": album['album_type'],
-                    "ALBUM_RELEASE": album['release_date'],
-                    "TOTAL_TRACKS": album['total_tracks']
-                }
-
-                chunk_api_album_details.append(ALBUM_API_DETAILS)
-
-
-            for i in range(len(chunk_ids)):
-
-                ALBUM_DETAILS = {
-                    "ALBUM_ID": chunk_base_album_details[i]['ALBUM_ID'],
-                    "ALBUM_NAME": chunk_api_album_details[i]['ALBUM_NAME'],
-                    "ALBUM_TYPE": chunk_api_album_details[i]['ALBUM_TYPE'],
-                    "ALBUM_RELEASE": chunk_api_album_details[i]['ALBUM_RELEASE'],
-                    "TOTAL_TRACKS": chunk_api_album_details[i]['TOTAL_TRACKS'],
-                    "TRACKS_ADDED": chunk_base_album_details[i]['TRACKS_ADDED'],
-                    "ADDED_PERCENT":chunk_base_album_details[i]['TRACKS_ADDED']/chunk_api_album_details[i]['TOTAL_TRACKS']
-                }
-                
-                
-                record_count += 1
-
-                # Insert into album details table
-                _c.execute("""
-                    INSERT INTO DIM_ALBUMS (
-                        ALBUM_ID,
-                        ALBUM_NAME,
-                        ALBUM_TYPE,
-                        ALBUM_RELEASE, 
-                        TOTAL_TRACKS, 
-                        TRACKS_ADDED,
-                        ADDED_PERCENT)
-                    VALUES(
-                        :ALBUM_ID,
-                        :ALBUM_NAME,
-                        :ALBUM_TYPE,
-                        :ALBUM_RELEASE, 
-                        :TOTAL_TRACKS, 
-                        :TRACKS_ADDED,
-                        :ADDED_PERCENT)  
-                """,ALBUM_DETAILS)
-
-        _db.commit()
 
-        utilities.get_finish_info(record_count)
+        # Albums come from the track payloads of get_track_info, only albums missing from those are requested
+        # Album names, types and release dates are stable so cached albums are reused for longer. API takes 20 (max) at a time
+        missing_ids = [album[0] for album in albums if album[0] not in track_albums]
+        track_albums.update(zip(missing_ids, get_entities("album", missing_ids, engine)))
+        api_albums = [track_albums[album[0]] for album in albums]
+
+        # Build album details from sql results and api
+        rows = [album_row(album_id, tracks_added, api_album) for (album_id, tracks_added), api_album in zip(albums, api_albums) if api_album is not None]
+        log_missing("album", [album[0] for album, api_album in zip(albums, api_albums) if api_album is None])
+
+        # Insert into album details table
+        _writer.write([
+            db_writer.statement("DELETE FROM STAGING_DIM_ALBUMS"),
+            db_writer.insert("STAGING_DIM_ALBUMS", DIM_ALBUMS_COLUMNS, rows)
+        ], wait=True)
+
+        utilities.get_finish_info(len(rows))
         utilities.write_log() 
 
     except Exception as e:
         utilities.get_error_message(e.args[0])
         utilities.write_log()
 
-        _db.commit()
-
-def get_artists():
+def get_artists(engine=ENRICH_ENGINE):
      # Function to iterate through all distinct tracks populated in the fact tables
 
     try:
-        _c.execute("""
-        DROP TABLE IF EXISTS DIM_ARTISTS
-        """)
-
-        _c.execute("""
-            CREATE TABLE IF NOT EXISTS DIM_ARTISTS(
-                ARTIST_ID TEXT,
-                ARTIST_NAME TEXT,
-                ARTIST_TYPE TEXT,
-                ARTIST_POPULARITY INTEGER,
-                TRACKS_ADDED INTEGER)
-            """)
-        
         # Start by getting list of all unique artists and the count of tracks from each artist stored in playlist
         utilities.get_start_info("DIM_ARTISTS")
-        record_count = 0
+        connect_spotify()
 
         # Query to return each unique artist ID
         # Also return the count of tracks from each artist stored
         _c.execute("""
-            SELECT PRIMARY_ARTIST_ID, COUNT(TRACK_ID) 
-            FROM DIM_TRACKS
+            SELECT PRIMARY_ARTIST_ID, COUNT(*)
+            FROM STAGING_DIM_TRACKS
             WHERE PLAYLIST_COUNT IS NOT NULL
             GROUP BY PRIMARY_ARTIST_ID
         """)
         artists = _c.fetchall()
 
-        arists_chunks = (list(utilities.chunk_list(artists,50)))
-
-        for artists_chunk in arists_chunks:
-            chunk_ids = []
-            chunk_base_artist_details = []
-            chunk_api_artist_details = []
-
-            for artist in artists_chunk:
-
-                # Build album details dict from sql results and api
-                ARTIST_BASE_DETAILS = {
-                    "ARTIST_ID": artist[0],
-                    "TRACKS_ADDED": artist[1]
-                }
-
-                chunk_base_artist_details.append(ARTIST_BASE_DETAILS)
-                chunk_ids.append(artist[0])
-
-            artists = sp.artists(chunk_ids)['artists']
-
-            for artist in artists:
-                ARTIST_API_DETAILS = {
-                    "ARTIST_ID": artist['id'],
-                    "ARTIST_NAME": artist['name'],
-                    "ARTIST_TYPE": artist['type'],
-                    "ARTIST_POPULARITY": artist['popularity']
-                }
-
-                chunk_api_artist_details.append(ARTIST_API_DETAILS)
-            
-            for i in range(len(chunk_ids)):
-
-                # Build artist details dict from sql results and api
-                ARTIST_DETAIL = {
-                    "ARTIST_ID": chunk_base_artist_details[i]['ARTIST_ID'],
-                    "ARTIST_NAME": chunk_api_artist_details[i]['ARTIST_NAME'],
-                    "ARTIST_TYPE": chunk_api_artist_details[i]['ARTIST_TYPE'],
-                    "ARTIST_POPULARITY": chunk_api_artist_details[i]['ARTIST_POPULARITY'],
-                    "TRACKS_ADDED": chunk_base_artist_details[i]['TRACKS_ADDED']
-                }
-
-                record_count += 1
-
-                # Insert into artist details table
-                _c.execute("""
-                    INSERT INTO DIM_ARTISTS (
-                        ARTIST_ID,
-                        ARTIST_NAME,
-                        ARTIST_TYPE,
-                        ARTIST_POPULARITY, 
-                        TRACKS_ADDED)
-                    VALUES(
-                        :ARTIST_ID,
-                        :ARTIST_NAME,
-                        :ARTIST_TYPE,
-                        :ARTIST_POPULARITY, 
-                        :TRACKS_ADDED)  
-                """,ARTIST_DETAIL)
-
-        _db.commit()
+        api_artists = get_entities("artist", [artist[0] for artist in artists], engine)
 
-        utilities.get_finish_info(record_count)
+        # Build artist details from sql results and api
+        rows = [artist_row(artist_id, tracks_added, api_artist) for (artist_id, tracks_added), api_artist in zip(artists, api_artists) if api_artist is not None]
+        log_missing("artist", [artist[0] for artist, api_artist in zip(artists, api_artists) if api_artist is None])
+
+        # Insert into artist details table
+        _writer.write([
+            db_writer.statement("DELETE FROM STAGING_DIM_ARTISTS"),
+            db_writer.insert("STAGING_DIM_ARTISTS", DIM_ARTISTS_COLUMNS, rows)
+        ], wait=True)
+
+        utilities.get_finish_info(len(rows))
         utilities.write_log() 
 
     except Exception as e:
         utilities.get_error_message(e.args[0])
         utilities.write_log()
 
-        _db.commit()
-
-get_top_tracks("short_term")
-get_top_tracks("medium_term")
-get_top_tracks("long_term")
-get_liked_tracks()
-get_playlists()
-get_track_info()
-get_albums()
-get_artists()
-_db.close()
\ No newline at end of file
+def get_enrichment():
+    # Function to populate DIM_TRACKS, DIM_ALBUMS and DIM_ARTISTS in one pipelined stage rather than three stages one after another
+    # Artist IDs (and any albums not embedded in the tracks) are queued as each track batch resolves, so their requests overlap with the remaining track requests
+    # Each table is also logged on its own, ending when its last payload was handled
+
+    try:
+        utilities.get_start_info("DIM_TRACKS, DIM_ALBUMS, DIM_ARTISTS (Pipelined)")
+        connect_spotify()
+        start_time = datetime.now()
+
+        tracks = {track[0]: track for track in get_track_metrics()}
+
+        # Count of tracks in a playlist from each album and artist, built up as tracks resolve
+        album_tracks = {}
+        artist_tracks = {}
+        api_albums = {}
+        api_artists = {}
+        record_counts = dict.fromkeys(("track", "album", "artist"), 0)
+        missing_tracks = []
+        writes = [_writer.write([db_writer.statement(f"DELETE FROM STAGING_{table}") for table in ("DIM_TRACKS", "DIM_ALBUMS", "DIM_ARTISTS")])]
+
+        def tracks_resolved(track_ids, api_tracks):
+            rows = [track_row(tracks[track_id], api_track) for track_id, api_track in zip(track_ids, api_tracks) if api_track is not None]
+            missing_tracks.extend(track_id for track_id, api_track in zip(track_ids, api_tracks) if api_track is None)
+            writes.append(_writer.write([db_writer.insert("STAGING_DIM_TRACKS", DIM_TRACKS_COLUMNS, rows)]))
+            record_counts["track"] += len(rows)
+
+            # Albums and artists only include tracks in a playlist, matching PLAYLIST_COUNT IS NOT NULL in get_albums and get_artists
+            # Albums embedded in the tracks are used as they are, only incomplete ones are queued
+            api_albums.update(embedded_albums(api_tracks))
+            album_ids = []
+            artist_ids = []
+            for row in rows:
+                if row[8] is not None:
+                    if row[3] not in api_albums:
+                        album_ids.append(row[3])
+                    artist_ids.append(row[2])
+                    album_tracks[row[3]] = album_tracks.get(row[3], 0) + 1
+                    artist_tracks[row[2]] = artist_tracks.get(row[2], 0) + 1
+            pipeline.put("album", album_ids)
+            pipeline.put("artist", artist_ids)
+
+        pipeline = enrich_pipeline.EnrichmentPipeline()
+        # Handlers receive records, payloads are projected as they are read from the cache or once each fetched batch is cached
+        pipeline.add_entity_type(
+            "track",
+            get_fetch_batch("track"),
+            ENTITY_ENDPOINTS["track"][1],
+            ENTITY_FIELDS["track"],
+            tracks_resolved,
+            project=records.TrackRecord.from_payload)
+        for entity_type, payloads in (("album", api_albums), ("artist", api_artists)):
+            pipeline.add_entity_type(
+                entity_type,
+                get_fetch_batch(entity_type),
+                ENTITY_ENDPOINTS[entity_type][1],
+                ENTITY_FIELDS[entity_type],
+                lambda ids, api_entities, payloads=payloads: payloads.update(zip(ids, api_entities)),
+                sources=("track",),
+                project=records.ENTITY_RECORDS[entity_type].from_payload)
+
+        # Track rows are queued to the writer as they resolve, album and artist rows once every track has been counted
+        pipeline.put("track", tracks)
+        pipeline.run()
+
+        album_rows = [album_row(album_id, tracks_added, api_albums[album_id]) for album_id, tracks_added in album_tracks.items() if api_albums.get(album_id) is not None]
+        artist_rows = [artist_row(artist_id, tracks_added, api_artists[artist_id]) for artist_id, tracks_added in artist_tracks.items() if api_artists.get(artist_id) is not None]
+        log_missing("track", missing_tracks)
+        log_missing("album", [album_id for album_id in album_tracks if api_albums.get(album_id) is None])
+        log_missing("artist", [artist_id for artist_id in artist_tracks if api_artists.get(artist_id) is None])
+        writes.append(_writer.write([
+            db_writer.insert("STAGING_DIM_ALBUMS", DIM_ALBUMS_COLUMNS, album_rows),
+            db_writer.insert("STAGING_DIM_ARTISTS", DIM_ARTISTS_COLUMNS, artist_rows)
+        ]))
+        record_counts["album"] = len(album_rows)
+        record_counts["artist"] = len(artist_rows)
+        _writer.wait_all(writes)
+
+        for entity_type, table in (("track", "DIM_TRACKS"), ("album", "DIM_ALBUMS"), ("artist", "DIM_ARTISTS")):
+            # Albums taken from the tracks are done when the tracks are
+            end_time = pipeline.finished_at(entity_type) or pipeline.finished_at("track") or start_time
+            utilities.log_result(table, start_time, end_time, record_counts[entity_type])
+
+        utilities.get_finish_info(sum(record_counts.values()))
+        utilities.write_log()
+
+    except Exception as e:
+        utilities.get_error_message(e.args[0])
+        utilities.write_log()
+
+def get_enrichment_inputs():
+    # Fingerprint of everything the enrichment stages read, FACT_TRACKS and DIM_COLLECTIONS in key order
+    fingerprint = hashlib.sha1()
+    for query in (
+        "SELECT * FROM STAGING_FACT_TRACKS ORDER BY COLLECTION_ID, COLLECTION_POSITION",
+        "SELECT * FROM STAGING_DIM_COLLECTIONS ORDER BY ID"):
+        for row in _db.execute(query):
+            fingerprint.update(repr(row).encode())
+    return fingerprint.hexdigest()
+
+def run_enrichment(engine=ENRICH_ENGINE, force=False):
+    # Populate DIM_TRACKS, DIM_ALBUMS and DIM_ARTISTS with the chosen engine, skipped if the inputs are unchanged since the last enrichment (within ENRICH_MAX_AGE)
+    input_fingerprint = get_enrichment_inputs()
+    last_run = _db.execute("SELECT INPUT_FINGERPRINT, COMPLETED_AT FROM STAGING_STAGE_STATE WHERE STAGE = 'enrich'").fetchone()
+    if not force and last_run is not None and last_run[0] == input_fingerprint and datetime.fromisoformat(last_run[1]) > datetime.now() - ENRICH_MAX_AGE:
+        utilities.log_result("DIM_TRACKS, DIM_ALBUMS, DIM_ARTISTS (Skipped, inputs unchanged)", datetime.now(), datetime.now(), 0)
+        return
+
+    failed_count = len(utilities.failed_stages)
+    if engine == "pipeline":
+        get_enrichment()
+    else:
+        get_track_info(engine)
+        get_albums(engine)
+        get_artists(engine)
+
+    # Fingerprint is stored in staging with the tables it describes, so it's swapped in (or discarded) with them
+    if len(utilities.failed_stages) == failed_count:
+        _writer.write([db_writer.statement("""
+            INSERT OR REPLACE INTO STAGING_STAGE_STATE (STAGE, INPUT_FINGERPRINT, COMPLETED_AT)
+            VALUES ('enrich', ?, ?)
+        """, (input_fingerprint, datetime.now().isoformat()))], wait=True)
+
+def swap_tables():
+    # Swap the staging tables in only if every stage succeeded, otherwise the previous extract stays in place
+    try:
+        utilities.get_start_info("SWAP STAGING TABLES")
+        if utilities.failed_stages:
+            raise Exception(f"Not swapped, failed stages: {', '.join(utilities.failed_stages)}")
+
+        utilities.swap_staging_tables(_db, TABLE_SCHEMAS, TABLE_INDEXES)
+        utilities.clear_checkpoints(_db)
+        utilities.get_finish_info(len(TABLE_SCHEMAS))
+        utilities.write_log()
+
+    except Exception as e:
+        utilities.get_error_message(e.args[0])
+        utilities.write_log()
+
+def update_search_index():
+    # Update the name search over the swapped in DIM tables, only names that changed are re-indexed (see search)
+    try:
+        utilities.get_start_info("SEARCH INDEX")
+        utilities.get_finish_info(search.update_index(_db))
+        utilities.write_log()
+
+    except Exception as e:
+        utilities.get_error_message(e.args[0])
+        utilities.write_log()
+
+# Stages of a run, as {name: (function taking the engine and force flag, tables read, tables written)}
+# Tables read only count rows written by other stages (e.g. not liked tracks reading its last sync), see stage_scheduler for how they're ordered
+# The collection stages each write their own rows and can run at the same time. Enrichment waits for all of them
+STAGES = {
+    "top-tracks:short_term" : (lambda engine, force: get_top_tracks("short_term"), (), ("FACT_TRACKS", "DIM_COLLECTIONS")),
+    "top-tracks:medium_term" : (lambda engine, force: get_top_tracks("medium_term"), (), ("FACT_TRACKS", "DIM_COLLECTIONS")),
+    "top-tracks:long_term" : (lambda engine, force: get_top_tracks("long_term"), (), ("FACT_TRACKS", "DIM_COLLECTIONS")),
+    "liked-tracks" : (lambda engine, force: get_liked_tracks(), (), ("FACT_TRACKS", "DIM_COLLECTIONS")),
+    "playlists" : (lambda engine, force: get_playlists(), (), ("FACT_TRACKS", "DIM_COLLECTIONS", "PLAYLIST_STATE")),
+    "enrich" : (run_enrichment, ("FACT_TRACKS", "DIM_COLLECTIONS"), ("DIM_TRACKS", "DIM_ALBUMS", "DIM_ARTISTS", "STAGE_STATE"))
+}
+
+# Names that can be selected, a name before the colon (e.g. top-tracks) selects every stage it starts
+STAGE_NAMES = tuple(dict.fromkeys(stage.split(":")[0] for stage in STAGES))
+
+def http_pool_size(max_parallel):
+    # Most API calls that can be in flight at once: every running stage fetching with its widest fan out (playlists fetch several at a time, each several pages ahead)
+    return max_parallel * max(
+        utilities.PAGE_WORKERS,
+        PLAYLIST_WORKERS * utilities.PAGE_WORKERS,
+        enrich_pipeline.PIPELINE_CONCURRENCY,
+        async_fetch.ENRICH_CONCURRENCY)
+
+def run(stages=STAGE_NAMES, engine=ENRICH_ENGINE, force=False, resume=False, max_parallel=stage_scheduler.MAX_PARALLEL_STAGES):
+    # Run the selected stages against staging tables, then swap them in. Returns the stages logged as failed
+    # force runs enrichment even if its inputs haven't changed
+    # resume continues an interrupted run from its staging tables, skipping the collections and playlists it completed
+    # Enrichment has no checkpoints of its own, batches fetched before the interruption are served from the entity cache
+    # max_parallel caps the stages running at the same time
+    global _db, _c, _writer, _pool_size
+    # State of the previous run in this process (e.g. from a test or benchmark) is cleared, so its failures don't block this run's swap
+    utilities.failed_stages.clear()
+    track_albums.clear()
+    _pool_size = http_pool_size(max_parallel)
+    connect_database(resume)
+    try:
+        stage_scheduler.run_stages(
+            {
+                stage: (lambda function=function: function(engine, force), tables_read, tables_written)
+                for stage, (function, tables_read, tables_written) in STAGES.items()
+                if stage in stages or stage.split(":")[0] in stages
+            },
+            max_parallel)
+        _writer.flush()
+        swap_tables()
+        if not utilities.failed_stages:
+            update_search_index()
+    finally:
+        start_time = datetime.now()
+        _writer.close()
+        utilities.log_result("DATABASE WRITER", start_time, datetime.now(), _writer.stats["rows"])
+        metrics.record_component("RUN_WRITER_METRICS", _writer.metrics_row())
+        _writer = None
+        if sp is not None:
+            now = datetime.now()
+            utilities.log_result("HTTP TRANSPORT", now, now, rate_limit.stats["calls"])
+            metrics.record_component("RUN_TRANSPORT_METRICS", (_pool_size, rate_limit.stats["calls"], transport.connections_opened(sp._session)))
+        utilities.flush_logs(finish_run=True)
+        _db.close()
+        _db = _c = None
+
+    return list(utilities.failed_stages)
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract Spotify library data into SQLite")
+    parser.add_argument("stages", nargs="*", metavar="stage", help=f"stages to run, default all of: {', '.join(STAGE_NAMES)}")
+    parser.add_argument("--engine", choices=("pipeline", "sync", "async"), default=ENRICH_ENGINE, help="fetch engine for the enrichment stages")
+    parser.add_argument("--force", action="store_true", help="run enrichment even if its inputs haven't changed")
+    parser.add_argument("--resume", action="store_true", help="continue the last run if it was interrupted before its tables were swapped in")
+    parser.add_argument("--max-parallel", type=int, default=stage_scheduler.MAX_PARALLEL_STAGES, help="stages run at the same time, 1 runs them one after another")
+    args = parser.parse_args()
+
+    unknown = set(args.stages) - set(STAGE_NAMES) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    if args.max_parallel < 1:
+        parser.error("--max-parallel must be at least 1")
+
+    if run(args.stages or STAGE_NAMES, args.engine, args.force, args.resume, args.max_parallel):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
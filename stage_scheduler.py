@@ -0,0 +1,57 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+import contextvars
+import utilities
+
+# Stages run at the same time by default. API calls of every stage go through the same rate limiter, so this mostly overlaps latency
+MAX_PARALLEL_STAGES = 3
+
+def stage_dependencies(stages):
+    # {stage: stages it waits for}, given stages as {name: (function, tables read, tables written)} in run order
+    # A stage waits for every earlier stage writing a table it reads, so declaration order settles any cycle
+    names = list(stages)
+    return {
+        name: {other for other in names[:index] if set(stages[other][2]) & set(stages[name][1])}
+        for index, name in enumerate(names)
+    }
+
+def run_stages(stages, max_parallel=MAX_PARALLEL_STAGES):
+    # Run each stage once its dependencies have finished, at most max_parallel at a time. max_parallel 1 runs them in order
+    # Stages log their own results. Each is also logged as a whole with its wall time, from starting to finishing
+    # Each stage runs in a copy of the caller's context, so the log entry and metrics of one stage aren't seen by another
+    # An exception raised by a stage stops any more from starting, and is raised once the running ones finish
+    dependencies = stage_dependencies(stages)
+    pending = list(stages)
+    finished = set()
+    running = {}
+    error = None
+
+    def run_stage(name):
+        start_time = datetime.now()
+        try:
+            stages[name][0]()
+        except BaseException as e:
+            utilities.log_result(f"STAGE ({name})", start_time, datetime.now(), 0, f"{type(e).__name__}: {e}")
+            raise
+        utilities.log_result(f"STAGE ({name})", start_time, datetime.now(), 0)
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        while True:
+            for name in list(pending):
+                if error is not None or len(running) >= max_parallel:
+                    break
+                if dependencies[name] <= finished:
+                    pending.remove(name)
+                    running[pool.submit(contextvars.copy_context().run, run_stage, name)] = name
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished.add(running.pop(future))
+                if future.exception() is not None and error is None:
+                    error = future.exception()
+
+    if error is not None:
+        raise error
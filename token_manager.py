@@ -0,0 +1,59 @@
+import threading
+import time
+import warnings
+import rate_limit
+
+# The access token is refreshed this many seconds before it expires (tokens last an hour), leaving time to retry a failed refresh
+REFRESH_MARGIN = 300
+
+class TokenManager:
+    # spotipy auth manager keeping the access token in memory, so API calls don't read and validate the cache file each time
+    # A background thread refreshes the token before it expires. The cache file is only written by a refresh, when the token has changed
+    # Shared by every thread using the client. A call only refreshes inline if the token has expired anyway (e.g. every background attempt failed), and threads arriving together wait for one refresh
+
+    def __init__(self, oauth, refresh_margin=REFRESH_MARGIN):
+        self.oauth = oauth
+        self.refresh_margin = refresh_margin
+        self.token_info = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def get_access_token(self, as_dict=False):
+        # Called by spotipy for every request
+        token_info = self.token_info
+        if token_info is None or self.oauth.is_token_expired(token_info):
+            token_info = self.refresh(token_info)
+        return token_info if as_dict else token_info["access_token"]
+
+    def refresh(self, stale):
+        # Replace the stale token (None on first use), unless another thread already has
+        with self.lock:
+            if self.token_info is not stale:
+                return self.token_info
+
+            if stale is None:
+                # First use reads the cache file, refreshing it or asking for authorisation as SpotifyOAuth would
+                # The token returned is kept rather than read back from the cache, which may not have been written (spotipy only warns)
+                # as_dict is deprecated in spotipy but is the only way to get the expiry with the token
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", DeprecationWarning)
+                    self.token_info = self.oauth.get_access_token(as_dict=True)
+                self.thread = threading.Thread(target=self.run, name="token-refresh", daemon=True)
+                self.thread.start()
+            else:
+                self.token_info = self.oauth.refresh_access_token(stale["refresh_token"])
+            return self.token_info
+
+    def run(self):
+        # Refresh refresh_margin seconds before expiry (half way through for tokens shorter than that). Failures are retried with backoff until a token replaces this one
+        while True:
+            token_info = self.token_info
+            margin = min(self.refresh_margin, token_info.get("expires_in", 2 * self.refresh_margin) / 2)
+            time.sleep(max(0, token_info["expires_at"] - margin - time.time()))
+            attempt = 0
+            while self.token_info is token_info:
+                try:
+                    self.refresh(token_info)
+                except Exception:
+                    time.sleep(rate_limit.backoff_seconds(attempt))
+                    attempt += 1
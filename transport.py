@@ -0,0 +1,43 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+# HTTP session used by the spotipy client. One pool of keep-alive connections per host, shared by every thread making API calls
+# Connections are opened as needed up to the pool size and kept for reuse, so parallel stages don't each pay for a new TCP and TLS handshake per call
+
+# Hosts given their own pool (api.spotify.com, and accounts.spotify.com if the token is refreshed through the same session)
+POOL_HOSTS = 2
+
+# Connections kept per host when no size is given, enough for one stage fetching playlists or pages in parallel. sp_extract_data sizes it to the stages run at once
+POOL_SIZE = 32
+
+# Seconds to wait for a connection, and for each read of a response. The API answers batch calls well within READ_TIMEOUT
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 15
+TIMEOUTS = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# Responses are requested compressed, requests decodes them
+HEADERS = {
+    "Accept-Encoding" : "gzip, deflate",
+    "Connection" : "keep-alive"
+}
+
+def create_session(pool_size=POOL_SIZE):
+    # Session with a pool of pool_size connections per host. Requests beyond that still go ahead on a new connection, which is closed rather than kept
+    # urllib3 retries are turned off, retries are left to RateLimitedSpotify so they go through the rate limiter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=pool_size, max_retries=0, pool_block=False)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(HEADERS)
+    return session
+
+def connections_opened(session):
+    # Connections opened by the session's pools so far, compared with the calls made this shows how often a connection was reused
+    opened = 0
+    for adapter in set(session.adapters.values()):
+        pools = getattr(adapter, "poolmanager", None)
+        if pools is None:
+            continue
+        for key in pools.pools.keys():
+            opened += pools.pools[key].num_connections
+    return opened
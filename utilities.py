@@ -1,75 +1,269 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from itertools import islice
+import atexit
+import contextvars
+import os
 import sqlite3
+import threading
+import metrics
 
-_log_info = {
-    "script_name" : None,
-    "script_success" : 0,
-    "record_count" : 0,
-    "script_start_time" : None,
-    "script_end_time" : None,
-    "script_error_message" : "No Error Message"
+# Database the extract is written to, SP_DB_PATH in the environment overrides it (e.g. for benchmarks)
+DB_PATH = os.environ.get("SP_DB_PATH", '/usr/files/spotify_data/sp_data.db')
+
+# PRAGMAs applied to every connection made by connect()
+# WAL lets readers continue during a write, NORMAL sync is safe with WAL, negative cache size is in KiB
+DB_PRAGMAS = {
+    "journal_mode" : "WAL",
+    "synchronous" : "NORMAL",
+    "cache_size" : -64000,
+    "temp_store" : "MEMORY"
+}
+
+# Each run builds into tables with this prefix, which are only swapped in once every stage has succeeded
+STAGING_PREFIX = "STAGING_"
+
+# Units of work (e.g. one playlist) completed by the current run, kept until its staging tables are swapped in
+# An interrupted run can be resumed from its staging tables, skipping the units recorded here
+CHECKPOINT_TABLE = "RUN_CHECKPOINTS"
+
+# Largest page size each paginated endpoint accepts
+PAGE_LIMITS = {
+    "saved_tracks" : 50,
+    "top_tracks" : 50,
+    "playlists" : 50,
+    "playlist_items" : 100
 }
 
-def init_logging_table():
+# Fields filter sent to paginated endpoints that accept one, only what's read from each page is returned
+# Spotify only supports fields on the playlist endpoints. Pages from the others are projected to rows as they arrive instead
+PAGE_FIELDS = {
+    "playlist_items" : "items(added_at,track(id,type)),total,limit"
+}
+
+# Number of pages fetched at the same time when paginating by offset
+PAGE_WORKERS = 8
+
+# Log entries are buffered and written in batches of this size (and at the end of the run) over one connection
+LOG_FLUSH_SIZE = 50
+
+_log_db = None
+_log_buffer = []
+_log_lock = threading.Lock()
+
+# Every connection made by connect() writes the same database file, and stages on different threads share them
+# transaction() holds this lock, so only one transaction is open at a time. Reentrant so a log flush can happen inside a transaction
+_db_lock = threading.RLock()
+
+# Names of stages logged as failed this run
+failed_stages = []
+
+# Log entry of the stage running in the current context, so stages on different threads each keep their own. Set by get_start_info
+_log_info = contextvars.ContextVar("log_info")
+
+def connect(db_path=DB_PATH):
+    # Open a connection with the configured PRAGMAs
+    # Autocommit mode, so writes are grouped with transaction() rather than sqlite3's implicit transactions
+    # Can be used from any thread, transaction() keeps them from interleaving
+    _db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    for pragma, value in DB_PRAGMAS.items():
+        _db.execute(f"PRAGMA {pragma} = {value}")
+    return _db
+
+@contextmanager
+def transaction(db):
+    # Run the block in one explicit transaction, committed on success and rolled back on any exception
+    # Other threads wait for the transaction to finish before starting theirs
+    with _db_lock:
+        db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+
+def table_columns(db, table):
+    # Column names of a table, empty if it doesn't exist
+    return [column[1] for column in db.execute(f"PRAGMA table_info({table})")]
+
+def create_staging_tables(db, schemas, copy_tables=(), indexes={}):
+    # Recreate an empty staging table for each schema ({table: definition after the table name}), which the run builds into instead of the live tables
+    # Tables in copy_tables are updated incrementally, so their staging table starts with the live table's rows (columns in both only)
+    # Rows repeating a staging key are skipped, as tables written before the keys were added can hold duplicates (e.g. a playlist's tracks inserted twice)
+    # indexes ({table: {index name: definition}}) are built on the staging tables under prefixed names, after any rows are copied
+    with transaction(db):
+        for table, definition in schemas.items():
+            db.execute(f"DROP TABLE IF EXISTS {STAGING_PREFIX}{table}")
+            db.execute(f"CREATE TABLE {STAGING_PREFIX}{table}{definition}")
+
+            if table in copy_tables:
+                staging_columns = table_columns(db, f"{STAGING_PREFIX}{table}")
+                shared_columns = ", ".join(column for column in table_columns(db, table) if column in staging_columns)
+                if shared_columns:
+                    db.execute(f"""
+                        INSERT OR IGNORE INTO {STAGING_PREFIX}{table} ({shared_columns})
+                        SELECT {shared_columns} FROM {table}
+                    """)
+
+            for index, index_definition in indexes.get(table, {}).items():
+                db.execute(f"CREATE INDEX {STAGING_PREFIX}{index} ON {STAGING_PREFIX}{table}{index_definition}")
+
+def swap_staging_tables(db, tables, indexes={}):
+    # Replace each live table with its staging table in one transaction
+    # Readers (WAL) keep seeing the previous tables until the commit, then see the complete new set
+    # Index names don't change when a table is renamed, so the staging indexes are rebuilt under their live names
+    with transaction(db):
+        for table in tables:
+            db.execute(f"DROP TABLE IF EXISTS {table}")
+            db.execute(f"ALTER TABLE {STAGING_PREFIX}{table} RENAME TO {table}")
+
+            for index, definition in indexes.get(table, {}).items():
+                db.execute(f"DROP INDEX {STAGING_PREFIX}{index}")
+                db.execute(f"CREATE INDEX {index} ON {table}{definition}")
+
+def staging_tables_exist(db, tables):
+    # True if every table has a staging table, i.e. a run was interrupted before swapping them in
+    return all(table_columns(db, f"{STAGING_PREFIX}{table}") for table in tables)
+
+def load_checkpoints(db, resume=False):
+    # Create the checkpoint table if needed and return the units already completed
+    # Without resume the previous run's checkpoints are cleared, call this before its staging tables are rebuilt
+    with transaction(db):
+        db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE}(
+            UNIT TEXT PRIMARY KEY,
+            COMPLETED_AT TEXT)
+        """)
+        if not resume:
+            db.execute(f"DELETE FROM {CHECKPOINT_TABLE}")
+    return {row[0] for row in db.execute(f"SELECT UNIT FROM {CHECKPOINT_TABLE}")}
+
+def checkpoint(unit):
+    # Statement recording a unit as completed, as (sql, parameter rows). Written in the same unit as the rows it covers, so both are committed or neither is
+    return (f"""
+        INSERT OR REPLACE INTO {CHECKPOINT_TABLE} (UNIT, COMPLETED_AT)
+        VALUES (?, ?)
+    """, [(unit, datetime.now().isoformat())])
+
+def clear_checkpoints(db):
+    db.execute(f"DELETE FROM {CHECKPOINT_TABLE}")
+
+def get_log_db():
+    # Single connection used for LOGGING_TABLE and the metrics tables, opened (and the tables created) on first use
+    global _log_db
+    with _db_lock:
+        if _log_db is None:
+            _log_db = connect()
+            init_logging_table(_log_db)
+    return _log_db
+
+def init_logging_table(_db):
     # Function to create table if not existing. Also clears any successful logs that are more than a month old
-    _db = sqlite3.connect('/usr/files/spotify_data/sp_data.db')
-    _c = _db.cursor()
-
-    _c.execute("""
-    CREATE TABLE IF NOT EXISTS LOGGING_TABLE(
-        script_name TEXT,
-        script_success INTEGER, 
-        record_count INTEGER, 
-        script_start_time TEXT,
-        script_end_time TEXT,
-        script_error_message TEXT)
-    """)
-
-    _c.execute("""
-    DELETE FROM LOGGING_TABLE WHERE  script_end_time < datetime('now','-1 months') AND script_success = 1;
-    """)
-    _db.commit()
-    _db.close()
+
+    with transaction(_db):
+        _db.execute("""
+        CREATE TABLE IF NOT EXISTS LOGGING_TABLE(
+            script_name TEXT,
+            script_success INTEGER, 
+            record_count INTEGER, 
+            script_start_time TEXT,
+            script_end_time TEXT,
+            script_error_message TEXT)
+        """)
+
+        _db.execute("""
+        DELETE FROM LOGGING_TABLE WHERE  script_end_time < datetime('now','-1 months') AND script_success = 1;
+        """)
+
+        metrics.init_tables(_db)
 
 def get_start_info(script_name):
     # Store script name and the datetime this function is called (will be called on start of scripts)
-    _log_info['script_name'] = script_name
-    _log_info['script_start_time'] = datetime.now()
+    # Also starts the stage's metrics, and clears any result left by the previous stage
+    _log_info.set({
+        "script_name" : script_name,
+        "script_success" : 0,
+        "record_count" : 0,
+        "script_start_time" : datetime.now(),
+        "script_end_time" : None,
+        "script_error_message" : "No Error Message"
+    })
+    metrics.start_stage(script_name)
 
 def get_finish_info(record_count):
     # Store the record count of insertions, and alter the success flag to show the script ran. Also get time of call to compare to start time
-    _log_info['script_end_time'] = datetime.now()
-    _log_info['script_success'] = 1
-    _log_info['record_count'] = record_count
+    log_info = _log_info.get()
+    log_info['script_end_time'] = datetime.now()
+    log_info['script_success'] = 1
+    log_info['record_count'] = record_count
 
 def get_error_message(error_message):
-    _log_info['script_error_message'] = error_message
+    _log_info.get()['script_error_message'] = error_message
 
 def write_log():
-    # Write to logging table
-    _db = sqlite3.connect('/usr/files/spotify_data/sp_data.db')
-    _c = _db.cursor()
-    _c.execute("""
-        INSERT INTO LOGGING_TABLE (
-            script_name,
-            script_success,
-            record_count,
-            script_start_time,
-            script_end_time,
-            script_error_message)
-        VALUES(
-            :script_name,
-            :script_success,
-            :record_count,
-            :script_start_time,
-            :script_end_time,
-            :script_error_message)    
-    """,_log_info)
-    _db.commit()
-    _db.close()
+    # Buffer the log entry and close the stage's metrics. Entries are written in batches by flush_logs
+    log_info = _log_info.get()
+    if log_info['script_end_time'] is None:
+        log_info['script_end_time'] = datetime.now()
+    buffer_log(dict(log_info))
+    if not log_info['script_success']:
+        failed_stages.append(log_info['script_name'])
+    metrics.finish_stage()
+
+def log_result(script_name, script_start_time, script_end_time, record_count, error_message=None):
+    # Write a log entry for a unit of work timed outside of _log_info (e.g. in a worker thread)
+    buffer_log({
+        "script_name" : script_name,
+        "script_success" : 0 if error_message else 1,
+        "record_count" : record_count,
+        "script_start_time" : script_start_time,
+        "script_end_time" : script_end_time,
+        "script_error_message" : error_message if error_message else "No Error Message"
+    })
+
+def buffer_log(log_entry):
+    with _log_lock:
+        _log_buffer.append(log_entry)
+        flush_needed = len(_log_buffer) >= LOG_FLUSH_SIZE
+    if flush_needed:
+        flush_logs()
+
+def flush_logs(finish_run=False):
+    # Write buffered log entries and finished stage metrics in one transaction
+    # finish_run also writes the run level metrics, used once at the end of a run
+    with _log_lock:
+        log_entries = list(_log_buffer)
+        _log_buffer.clear()
+
+    # Nothing was logged (e.g. the module was only imported), so the database isn't touched
+    if not log_entries and not finish_run and _log_db is None:
+        return
+
+    _db = get_log_db()
+    with transaction(_db):
+        _db.executemany("""
+            INSERT INTO LOGGING_TABLE (
+                script_name,
+                script_success,
+                record_count,
+                script_start_time,
+                script_end_time,
+                script_error_message)
+            VALUES(
+                :script_name,
+                :script_success,
+                :record_count,
+                :script_start_time,
+                :script_end_time,
+                :script_error_message)    
+        """,log_entries)
+        metrics.flush(_db, finish_run)
 
 def get_items(sp_connection, items_list):
-    # Function to take the items list of an API call then iterate through next flags
+    # Function to take the items list of an API call then iterate through next flags (serial fallback to iter_pages)
     # Ensures that despite limits, the full entirety of data is retrieved
     items = items_list['items']
 
@@ -79,9 +273,50 @@ def get_items(sp_connection, items_list):
     
     return items
 
+def iter_pages(fetch_page, page_limit, max_items=None, max_workers=PAGE_WORKERS):
+    # Generator yielding the items of each page of a paginated API call in order, using offsets rather than next flags
+    # fetch_page is called with limit and offset keywords. The first page gives the total and the limit actually applied
+    # Up to max_workers later pages are requested ahead of the consumer, so only that many pages are held in memory at once
+    # No more pages are requested once max_items have been yielded
+    if max_items is not None:
+        page_limit = max(1, min(page_limit, max_items))
+
+    first_page = fetch_page(limit=page_limit, offset=0)
+    metrics.count("pages_fetched")
+    limit = first_page['limit'] or page_limit
+    total = first_page['total'] if max_items is None else min(first_page['total'], max_items)
+    yield first_page['items'][:total]
+    del first_page
+
+    offsets = iter(range(limit, total, limit))
+
+    # Serial fallback, used when only one worker is requested
+    if max_workers <= 1:
+        for offset in offsets:
+            page = fetch_page(limit=limit, offset=offset)
+            metrics.count("pages_fetched")
+            yield page['items'][:total - offset]
+        return
+
+    fetch_page = metrics.bind(fetch_page)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque((offset, pool.submit(fetch_page, limit=limit, offset=offset)) for offset in islice(offsets, max_workers))
+        while pending:
+            offset, page = pending.popleft()
+            page = page.result()
+            metrics.count("pages_fetched")
+
+            # Keep the window full before handing the page over
+            next_offset = next(offsets, None)
+            if next_offset is not None:
+                pending.append((next_offset, pool.submit(fetch_page, limit=limit, offset=next_offset)))
+
+            yield page['items'][:total - offset]
+
 def chunk_list(list, length):
     # Function to seperate a list by the length parameter
     for i in range(0, len(list), length):
         yield list[i:i+length]
 
-init_logging_table()
\ No newline at end of file
+# Anything still buffered is written if the script exits early
+atexit.register(flush_logs)
\ No newline at end of file